@@ -1,7 +1,9 @@
 import streamlit as st
 import streamlit.components.v1
 import openai
-from datetime import datetime
+import httpx
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from uuid import uuid4
 import base64
 import requests
@@ -12,6 +14,16 @@ import pickle
 import os
 import glob
 import re
+import math
+import heapq
+import random
+import sqlite3
+import threading
+import copy
+import atexit
+import html
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 
 try:
     import tiktoken
@@ -20,14 +32,436 @@ try:
 except ImportError:
     TIKTOKEN_AVAILABLE = False
 
+DATABASE_FILE = "database/catgpt.db"
+GLOBAL_CHAT_RETENTION = 1000
+GLOBAL_CHAT_COMPACT_EVERY = 100
+ADMIN_SETTINGS_FILE = "database/admin_settings.json"
+WRITE_BEHIND_DELAY = 0.5
+
+DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_data (
+    username TEXT PRIMARY KEY,
+    chat_history TEXT NOT NULL DEFAULT '[]',
+    current_session_id TEXT,
+    model TEXT NOT NULL DEFAULT 'gpt-4o-mini',
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS chat_sessions (
+    username TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    name TEXT,
+    model TEXT,
+    created_at TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    messages TEXT NOT NULL DEFAULT '[]',
+    PRIMARY KEY (username, session_id)
+);
+CREATE TABLE IF NOT EXISTS global_chat (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT,
+    user_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_global_chat_message_id ON global_chat (message_id);
+CREATE TABLE IF NOT EXISTS device_sessions (
+    fingerprint TEXT PRIMARY KEY,
+    current_user TEXT,
+    last_access TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_device_sessions_user ON device_sessions (current_user);
+"""
+
+DATABASE_COLUMNS = {
+    "user_data": {
+        "rolling_summary": "TEXT"
+    },
+    "chat_sessions": {
+        "summary": "TEXT",
+        "summary_hash": "TEXT",
+        "rolling_summary": "TEXT"
+    }
+}
+
+SESSION_METADATA_COLUMNS = ["name", "model", "created_at", "message_count", "total_tokens", "summary", "summary_hash",
+                            "rolling_summary"]
+SESSION_JSON_COLUMNS = {"rolling_summary"}
+SUMMARY_CACHE_SIZE = 1000
+CONTEXT_WORKERS = 4
+SUMMARY_WORKERS = 8
+SUMMARY_TIMEOUT = 10
+ROLLING_SUMMARY_CHUNK_TOKENS = 6000
+OPENAI_CLIENT_DEFAULTS = {
+    "max_connections": 20,
+    "connect_timeout": 5,
+    "read_timeout": 60,
+    "max_retries": 2,
+    "max_in_flight": 8
+}
+SUMMARY_REQUEST_LANE = "__summaries__"
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 30
+STREAM_FLUSH_INTERVAL = 0.1
+STREAM_FLUSH_CHARS = 2048
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o-mini": 128000,
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000
+}
+RESPONSE_MAX_TOKENS = 2000
+RESPONSE_TEMPERATURE = 0.7
+RESPONSE_CACHE_DEFAULTS = {
+    "enabled": False,
+    "ttl": 3600,
+    "max_entries": 500,
+    "near_duplicates": False,
+    "similarity_threshold": 0.9
+}
+RESPONSE_CACHE_REPLAY_CHARS = 40
+NEAR_DUPLICATE_MIN_THRESHOLD = 0.9
+NEAR_DUPLICATE_MAX_WORDS = 24
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_PRIME = (1 << 61) - 1
+MESSAGE_TOKEN_OVERHEAD = 4
+SEARCH_TOP_K = 3
+SEARCH_SNIPPET_CHARS = 300
+SEARCH_BM25_K1 = 1.5
+SEARCH_BM25_B = 0.75
+SEARCH_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+SEARCH_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for", "from", "have", "how", "i",
+    "if", "in", "is", "it", "me", "my", "of", "on", "or", "so", "that", "the", "this", "to", "was", "we",
+    "what", "when", "with", "you", "your"
+}
+CUSTOM_DATA_CHUNK_TOKENS = 200
+CUSTOM_DATA_INLINE_TOKENS = 800
+CUSTOM_DATA_TOP_K = 4
+
+
+def import_legacy_json_files(conn):
+    if conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0 and os.path.exists("database/users.json"):
+        try:
+            with open("database/users.json", "r") as f:
+                users = json.load(f)
+            conn.executemany("INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                             [(username, json.dumps(data)) for username, data in users.items()])
+        except Exception:
+            pass
+
+    if conn.execute("SELECT COUNT(*) FROM user_data").fetchone()[0] == 0:
+        for user_data_file in glob.glob("database/catgpt_data_*.json"):
+            username = os.path.basename(user_data_file)[len("catgpt_data_"):-len(".json")]
+            try:
+                with open(user_data_file, "r") as f:
+                    data = json.load(f)
+                write_user_data(conn, username, data)
+            except Exception:
+                pass
+
+    if conn.execute("SELECT COUNT(*) FROM global_chat").fetchone()[0] == 0 and os.path.exists(
+            "database/global_chat.json"):
+        try:
+            with open("database/global_chat.json", "r") as f:
+                messages = json.load(f).get("messages", [])
+            conn.executemany("INSERT INTO global_chat (message_id, user_id, data) VALUES (?, ?, ?)",
+                             [(msg.get("message_id"), msg.get("user_id"), json.dumps(msg)) for msg in messages[-1000:]])
+        except Exception:
+            pass
+
+    if conn.execute("SELECT COUNT(*) FROM device_sessions").fetchone()[0] == 0:
+        for session_file in glob.glob("database/session_*.json"):
+            try:
+                with open(session_file, "r") as f:
+                    session_data = json.load(f)
+                conn.execute(
+                    "INSERT OR REPLACE INTO device_sessions (fingerprint, current_user, last_access, data) VALUES (?, ?, ?, ?)",
+                    (session_data.get("device_fingerprint", ""), session_data.get("current_user"),
+                     session_data.get("last_access"), json.dumps(session_data)))
+            except Exception:
+                pass
+
+
+@st.cache_resource
+def get_database():
+    if not os.path.exists("database"):
+        os.makedirs("database")
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(DATABASE_SCHEMA)
+    with conn:
+        for table, columns in DATABASE_COLUMNS.items():
+            existing_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for column, definition in columns.items():
+                if column not in existing_columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        import_legacy_json_files(conn)
+    conn.close()
+    return {"path": DATABASE_FILE, "local": threading.local()}
+
+
+def get_db_connection():
+    database = get_database()
+    conn = getattr(database["local"], "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(database["path"], timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        database["local"].conn = conn
+    return conn
+
+
+def write_user_data(conn, username, data, session_ids=None):
+    conn.execute(
+        """INSERT INTO user_data (username, chat_history, current_session_id, model, total_tokens, message_count,
+                                  rolling_summary, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT (username) DO UPDATE SET
+               chat_history = excluded.chat_history,
+               current_session_id = excluded.current_session_id,
+               model = excluded.model,
+               total_tokens = excluded.total_tokens,
+               message_count = excluded.message_count,
+               rolling_summary = excluded.rolling_summary,
+               updated_at = excluded.updated_at""",
+        (username, json.dumps(data.get("chat_history", [])), data.get("current_session_id"),
+         data.get("model", "gpt-4o-mini"), data.get("total_tokens", 0), data.get("message_count", 0),
+         json.dumps(data.get("rolling_summary")), datetime.now().isoformat()))
+
+    chat_sessions = data.get("chat_sessions", {})
+    if session_ids is not None:
+        chat_sessions = {session_id: chat_sessions[session_id] for session_id in session_ids
+                         if session_id in chat_sessions}
+    metadata_columns = ", ".join(SESSION_METADATA_COLUMNS)
+    metadata_updates = ", ".join(f"{column} = excluded.{column}" for column in SESSION_METADATA_COLUMNS)
+    placeholders = ", ".join("?" * (len(SESSION_METADATA_COLUMNS) + 2))
+    conn.executemany(
+        f"""INSERT INTO chat_sessions (username, session_id, {metadata_columns}) VALUES ({placeholders})
+            ON CONFLICT (username, session_id) DO UPDATE SET {metadata_updates}""",
+        [(username, session_id, *get_session_metadata_values(session))
+         for session_id, session in chat_sessions.items() if "messages" not in session])
+    conn.executemany(
+        f"""INSERT INTO chat_sessions (username, session_id, {metadata_columns}, messages) VALUES ({placeholders}, ?)
+            ON CONFLICT (username, session_id) DO UPDATE SET {metadata_updates}, messages = excluded.messages""",
+        [(username, session_id, *get_session_metadata_values(session), json.dumps(session["messages"]))
+         for session_id, session in chat_sessions.items() if "messages" in session])
+
+
+def get_session_metadata_values(session):
+    values = []
+    for column in SESSION_METADATA_COLUMNS:
+        value = session.get(column, 0 if column in ("message_count", "total_tokens") else None)
+        values.append(json.dumps(value) if column in SESSION_JSON_COLUMNS else value)
+    return values
+
+
+@st.cache_resource
+def get_user_data_writer():
+    writer = {"condition": threading.Condition(), "pending": {}}
+    thread = threading.Thread(target=run_user_data_writer, args=(writer,), name="user-data-writer", daemon=True)
+    thread.start()
+    atexit.register(flush_user_data_writes, writer)
+    return writer
+
+
+def run_user_data_writer(writer):
+    while True:
+        with writer["condition"]:
+            while not writer["pending"]:
+                writer["condition"].wait()
+        time.sleep(WRITE_BEHIND_DELAY)
+        flush_user_data_writes(writer)
+
+
+def flush_user_data_writes(writer):
+    with writer["condition"]:
+        batch = list(writer["pending"].items())
+
+    for username, entry in batch:
+        try:
+            conn = get_db_connection()
+            with conn:
+                write_user_data(conn, username, entry["data"], entry["session_ids"])
+        except Exception:
+            continue
+        with writer["condition"]:
+            if writer["pending"].get(username) is entry:
+                del writer["pending"][username]
+
+
+def queue_user_data_write(username, data, session_ids):
+    writer = get_user_data_writer()
+    with writer["condition"]:
+        entry = writer["pending"].get(username)
+        if entry is not None:
+            session_ids = entry["session_ids"] | session_ids
+            pending_sessions = entry["data"].get("chat_sessions", {})
+            chat_sessions = dict(data.get("chat_sessions", {}))
+            for session_id, session in chat_sessions.items():
+                if "messages" not in session and "messages" in pending_sessions.get(session_id, {}):
+                    chat_sessions[session_id] = dict(session, messages=pending_sessions[session_id]["messages"])
+            data = dict(data, chat_sessions=chat_sessions)
+        writer["pending"][username] = {"data": data, "session_ids": session_ids}
+        writer["condition"].notify()
+
+
+def get_pending_user_data(username):
+    writer = get_user_data_writer()
+    with writer["condition"]:
+        entry = writer["pending"].get(username)
+        return entry["data"] if entry is not None else None
+
+
+def get_user_data_signature(data):
+    chat_history = data.get("chat_history", [])
+    last_message = chat_history[-1] if chat_history else {}
+    rolling_summary = data.get("rolling_summary") or {}
+    return (data.get("current_session_id"), data.get("model"), data.get("total_tokens", 0),
+            data.get("message_count", 0), len(chat_history),
+            last_message.get("role"), last_message.get("content"), last_message.get("timestamp"),
+            rolling_summary.get("session_id"), rolling_summary.get("covered"))
+
+
+def get_session_signature(session):
+    return (*get_session_metadata_values(session), len(session["messages"]) if "messages" in session else None)
+
+
+def get_session_metadata(session):
+    return {key: value for key, value in session.items() if key != "messages"}
+
+
+def read_user_data(username):
+    pending = get_pending_user_data(username)
+    if pending is not None:
+        return dict(pending,
+                    chat_history=list(pending["chat_history"]),
+                    chat_sessions={session_id: get_session_metadata(session)
+                                   for session_id, session in pending["chat_sessions"].items()})
+
+    conn = get_db_connection()
+    row = conn.execute("SELECT * FROM user_data WHERE username = ?", (username,)).fetchone()
+    if row is None:
+        return None
+
+    chat_sessions = {}
+    for session in conn.execute(
+            f"""SELECT session_id, {", ".join(SESSION_METADATA_COLUMNS)} FROM chat_sessions
+                WHERE username = ? ORDER BY rowid""", (username,)):
+        chat_sessions[session["session_id"]] = dict(
+            {column: json.loads(session[column]) if column in SESSION_JSON_COLUMNS and session[column] else session[column]
+             for column in SESSION_METADATA_COLUMNS}, id=session["session_id"])
+
+    return {
+        "chat_history": json.loads(row["chat_history"]),
+        "chat_sessions": chat_sessions,
+        "current_session_id": row["current_session_id"],
+        "model": row["model"],
+        "total_tokens": row["total_tokens"],
+        "message_count": row["message_count"],
+        "rolling_summary": json.loads(row["rolling_summary"]) if row["rolling_summary"] else None
+    }
+
+
+def read_session_messages(username, session_id):
+    pending = get_pending_user_data(username)
+    if pending is not None:
+        session = pending["chat_sessions"].get(session_id, {})
+        if "messages" in session:
+            return list(session["messages"])
+
+    try:
+        row = get_db_connection().execute(
+            "SELECT messages FROM chat_sessions WHERE username = ? AND session_id = ?", (username, session_id)).fetchone()
+        return json.loads(row["messages"]) if row is not None else []
+    except Exception:
+        return []
+
+
+def read_user_model(username):
+    try:
+        row = get_db_connection().execute("SELECT model FROM user_data WHERE username = ?", (username,)).fetchone()
+        if row is not None and row["model"]:
+            return row["model"]
+    except Exception:
+        pass
+    return "gpt-4o-mini"
+
+
+def update_user_model(username, model):
+    try:
+        writer = get_user_data_writer()
+        with writer["condition"]:
+            entry = writer["pending"].get(username)
+            if entry is not None:
+                entry["data"] = dict(entry["data"], model=model)
+        conn = get_db_connection()
+        with conn:
+            conn.execute("UPDATE user_data SET model = ? WHERE username = ?", (model, username))
+    except Exception:
+        pass
+
+
+def delete_user_data(username):
+    writer = get_user_data_writer()
+    with writer["condition"]:
+        writer["pending"].pop(username, None)
+    conn = get_db_connection()
+    with conn:
+        conn.execute("DELETE FROM user_data WHERE username = ?", (username,))
+        conn.execute("DELETE FROM chat_sessions WHERE username = ?", (username,))
+    drop_user_search_index(username)
+
+
+def delete_session_data(device_fingerprint=None, username=None):
+    try:
+        conn = get_db_connection()
+        with conn:
+            if device_fingerprint is not None:
+                conn.execute("DELETE FROM device_sessions WHERE fingerprint = ?", (device_fingerprint,))
+            if username is not None:
+                conn.execute("DELETE FROM device_sessions WHERE current_user = ?", (username,))
+    except Exception:
+        pass
+
+
+@st.cache_resource
+def get_admin_settings_cache():
+    return {"lock": threading.Lock(), "stamp": None, "settings": None}
+
+
+def get_admin_settings_stamp():
+    try:
+        stat = os.stat(ADMIN_SETTINGS_FILE)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
 
 def load_admin_settings():
     try:
+        cache = get_admin_settings_cache()
+        stamp = get_admin_settings_stamp()
+        if stamp is not None:
+            with cache["lock"]:
+                if cache["stamp"] != stamp or cache["settings"] is None:
+                    with open(ADMIN_SETTINGS_FILE, "r") as f:
+                        cache["settings"] = json.load(f)
+                    cache["stamp"] = stamp
+                return copy.deepcopy(cache["settings"])
         if not os.path.exists("database"):
             os.makedirs("database")
-        if os.path.exists("database/admin_settings.json"):
-            with open("database/admin_settings.json", "r") as f:
-                return json.load(f)
         return {
             "api_key": st.secrets.get("OPENAI_API_KEY", ""),
             "system_prompt": "You are CatGPT, a helpful AI assistant. You have access to our previous conversation history and can reference past messages to provide contextual responses.",
@@ -35,9 +469,13 @@ def load_admin_settings():
                 "max_context_messages": 20,
                 "max_context_tokens": 4000,
                 "summarize_old_context": True,
-                "keep_important_messages": True
+                "keep_important_messages": True,
+                "retrieval_top_k": SEARCH_TOP_K
             },
             "global_image_generation": True,
+            "stream_flush_interval": STREAM_FLUSH_INTERVAL,
+            "openai_client": dict(OPENAI_CLIENT_DEFAULTS),
+            "response_cache": dict(RESPONSE_CACHE_DEFAULTS),
             "global_chat_refresh_interval": 3,
             "custom_data": "",
             "app_config": {
@@ -55,9 +493,13 @@ def load_admin_settings():
                 "max_context_messages": 20,
                 "max_context_tokens": 4000,
                 "summarize_old_context": True,
-                "keep_important_messages": True
+                "keep_important_messages": True,
+                "retrieval_top_k": SEARCH_TOP_K
             },
             "global_image_generation": True,
+            "stream_flush_interval": STREAM_FLUSH_INTERVAL,
+            "openai_client": dict(OPENAI_CLIENT_DEFAULTS),
+            "response_cache": dict(RESPONSE_CACHE_DEFAULTS),
             "global_chat_refresh_interval": 3,
             "custom_data": "",
             "app_config": {
@@ -143,27 +585,109 @@ def generate_browser_fingerprint():
     st.components.v1.html(fingerprint_js, height=0)
 
 
-def load_users():
+def read_users_from_db():
+    conn = get_db_connection()
+    rows = conn.execute("SELECT username, data FROM users ORDER BY rowid").fetchall()
+    if rows:
+        users = {row["username"]: json.loads(row["data"]) for row in rows}
+
+        for username in users:
+            if "image_generation" not in users[username]:
+                users[username]["image_generation"] = {
+                    "enabled": True,
+                    "daily_limit": 10,
+                    "usage_count": 0,
+                    "last_reset": datetime.now().strftime("%Y-%m-%d")
+                }
+        return users
+    return {"team-engineers": {"name": "Team Engineers", "email": "team@lexdata.com", "password": "LexData Labs",
+                               "status": "active", "authorized_devices": [],
+                               "image_generation": {"enabled": True, "daily_limit": 10, "usage_count": 0,
+                                                    "last_reset": datetime.now().strftime("%Y-%m-%d")}}}
+
+
+@st.cache_resource
+def get_user_directory():
+    return {"lock": threading.RLock(), "users": None, "device_index": {}}
+
+
+def index_user_devices(device_index, username, user_data):
+    for position, device in enumerate(user_data.get("authorized_devices", [])):
+        device_index.setdefault(device.get("fingerprint"), {})[username] = position
+
+
+def unindex_user_devices(device_index, username, user_data):
+    for device in user_data.get("authorized_devices", []):
+        fingerprint = device.get("fingerprint")
+        entries = device_index.get(fingerprint)
+        if entries is not None:
+            entries.pop(username, None)
+            if not entries:
+                del device_index[fingerprint]
+
+
+def load_user_directory():
+    directory = get_user_directory()
+    with directory["lock"]:
+        if directory["users"] is None:
+            users = read_users_from_db()
+            device_index = {}
+            for username, user_data in users.items():
+                index_user_devices(device_index, username, user_data)
+            directory["users"] = users
+            directory["device_index"] = device_index
+    return directory
+
+
+def get_user(username):
     try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        if os.path.exists("database/users.json"):
-            with open("database/users.json", "r") as f:
-                users = json.load(f)
+        directory = load_user_directory()
+        with directory["lock"]:
+            user_data = directory["users"].get(username)
+            return copy.deepcopy(user_data) if user_data is not None else None
+    except Exception:
+        return None
 
-            for username in users:
-                if "image_generation" not in users[username]:
-                    users[username]["image_generation"] = {
-                        "enabled": True,
-                        "daily_limit": 10,
-                        "usage_count": 0,
-                        "last_reset": datetime.now().strftime("%Y-%m-%d")
-                    }
-            return users
-        return {"team-engineers": {"name": "Team Engineers", "email": "team@lexdata.com", "password": "LexData Labs",
-                                   "status": "active", "authorized_devices": [],
-                                   "image_generation": {"enabled": True, "daily_limit": 10, "usage_count": 0,
-                                                        "last_reset": datetime.now().strftime("%Y-%m-%d")}}}
+
+def save_user(username, user_data):
+    try:
+        conn = get_db_connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO users (username, data) VALUES (?, ?) ON CONFLICT (username) DO UPDATE SET data = excluded.data",
+                (username, json.dumps(user_data)))
+        directory = get_user_directory()
+        with directory["lock"]:
+            if directory["users"] is not None:
+                previous = directory["users"].get(username)
+                if previous is not None:
+                    unindex_user_devices(directory["device_index"], username, previous)
+                directory["users"][username] = copy.deepcopy(user_data)
+                index_user_devices(directory["device_index"], username, user_data)
+    except Exception:
+        get_user_directory()["users"] = None
+
+
+def delete_user(username):
+    try:
+        conn = get_db_connection()
+        with conn:
+            conn.execute("DELETE FROM users WHERE username = ?", (username,))
+        directory = get_user_directory()
+        with directory["lock"]:
+            if directory["users"] is not None:
+                previous = directory["users"].pop(username, None)
+                if previous is not None:
+                    unindex_user_devices(directory["device_index"], username, previous)
+    except Exception:
+        get_user_directory()["users"] = None
+
+
+def load_users():
+    try:
+        directory = load_user_directory()
+        with directory["lock"]:
+            return copy.deepcopy(directory["users"])
     except Exception:
         return {"team-engineers": {"name": "Team Engineers", "email": "team@lexdata.com", "password": "LexData Labs",
                                    "status": "active", "authorized_devices": [],
@@ -171,69 +695,101 @@ def load_users():
                                                         "last_reset": datetime.now().strftime("%Y-%m-%d")}}}
 
 
-def save_global_chat_message(message):
+@st.cache_resource
+def get_global_chat_buffer():
+    buffer = {"lock": threading.Lock(), "entries": deque(maxlen=GLOBAL_CHAT_RETENTION), "seq": 0, "generation": 0}
     try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-
-        global_chat_file = "database/global_chat.json"
+        conn = get_db_connection()
+        rows = conn.execute("SELECT seq, data FROM global_chat ORDER BY seq DESC LIMIT ?",
+                            (GLOBAL_CHAT_RETENTION,)).fetchall()
+        buffer["entries"].extend((row["seq"], json.loads(row["data"])) for row in reversed(rows))
+        if rows:
+            buffer["seq"] = rows[0]["seq"]
+    except Exception:
+        pass
+    return buffer
 
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-        else:
-            global_chat = {"messages": []}
 
-        global_chat["messages"].append(message)
+def save_global_chat_message(message):
+    try:
+        buffer = get_global_chat_buffer()
+        with buffer["lock"]:
+            conn = get_db_connection()
+            with conn:
+                cursor = conn.execute("INSERT INTO global_chat (message_id, user_id, data) VALUES (?, ?, ?)",
+                                      (message.get("message_id"), message.get("user_id"), json.dumps(message)))
+            buffer["entries"].append((cursor.lastrowid, message))
+            buffer["seq"] = cursor.lastrowid
+        if cursor.lastrowid % GLOBAL_CHAT_COMPACT_EVERY == 0:
+            compact_global_chat()
+    except Exception:
+        pass
 
-        if len(global_chat["messages"]) > 1000:
-            global_chat["messages"] = global_chat["messages"][-1000:]
 
-        with open(global_chat_file, "w") as f:
-            json.dump(global_chat, f, indent=2)
+def compact_global_chat():
+    try:
+        conn = get_db_connection()
+        with conn:
+            conn.execute("DELETE FROM global_chat WHERE seq <= (SELECT MAX(seq) FROM global_chat) - ?",
+                         (GLOBAL_CHAT_RETENTION,))
     except Exception:
         pass
 
 
-def load_global_chat():
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
+def load_global_chat(limit=GLOBAL_CHAT_RETENTION):
+    buffer = get_global_chat_buffer()
+    with buffer["lock"]:
+        entries = list(buffer["entries"])
+    return [message for seq, message in entries[-limit:]]
 
-        global_chat_file = "database/global_chat.json"
 
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "r") as f:
-                global_chat = json.load(f)
-            return global_chat.get("messages", [])
-        return []
-    except Exception:
-        return []
+def load_global_chat_since(seq, limit=GLOBAL_CHAT_RETENTION):
+    buffer = get_global_chat_buffer()
+    delta = []
+    with buffer["lock"]:
+        for entry in reversed(buffer["entries"]):
+            if entry[0] <= seq or len(delta) >= limit:
+                break
+            delta.append(entry)
+    delta.reverse()
+    return delta
+
+
+def get_global_chat_version():
+    buffer = get_global_chat_buffer()
+    with buffer["lock"]:
+        return buffer["generation"], buffer["seq"]
+
+
+def count_global_chat_messages():
+    buffer = get_global_chat_buffer()
+    with buffer["lock"]:
+        return len(buffer["entries"])
 
 
 def clear_global_chat():
     try:
-        global_chat_file = "database/global_chat.json"
-        if os.path.exists(global_chat_file):
-            with open(global_chat_file, "w") as f:
-                json.dump({"messages": []}, f, indent=2)
+        buffer = get_global_chat_buffer()
+        with buffer["lock"]:
+            conn = get_db_connection()
+            with conn:
+                conn.execute("DELETE FROM global_chat")
+            buffer["entries"].clear()
+            buffer["generation"] += 1
     except Exception:
         pass
 
 
 def save_users(users):
     try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        with open("database/users.json", "w") as f:
-            json.dump(users, f, indent=2)
-    except Exception:
-        pass
-    try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-        with open("database/users.json", "w") as f:
-            json.dump(users, f, indent=2)
+        conn = get_db_connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO users (username, data) VALUES (?, ?) ON CONFLICT (username) DO UPDATE SET data = excluded.data",
+                [(username, json.dumps(data)) for username, data in users.items()])
+        directory = get_user_directory()
+        with directory["lock"]:
+            directory["users"] = None
     except Exception:
         pass
 
@@ -245,11 +801,10 @@ def check_image_generation_limit(username):
     if not global_image_enabled:
         return False, "Image generation is globally disabled by admin"
 
-    users = load_users()
-    if username not in users:
+    user_data = get_user(username)
+    if user_data is None:
         return False, "User not found"
 
-    user_data = users[username]
     image_settings = user_data.get("image_generation", {"enabled": True, "daily_limit": 10, "usage_count": 0,
                                                         "last_reset": datetime.now().strftime("%Y-%m-%d")})
 
@@ -262,8 +817,8 @@ def check_image_generation_limit(username):
     if last_reset != today:
         image_settings["usage_count"] = 0
         image_settings["last_reset"] = today
-        users[username]["image_generation"] = image_settings
-        save_users(users)
+        user_data["image_generation"] = image_settings
+        save_user(username, user_data)
 
     usage_count = image_settings.get("usage_count", 0)
     daily_limit = image_settings.get("daily_limit", 10)
@@ -275,9 +830,9 @@ def check_image_generation_limit(username):
 
 
 def increment_image_usage(username):
-    users = load_users()
-    if username in users:
-        image_settings = users[username].get("image_generation", {"enabled": True, "daily_limit": 10, "usage_count": 0,
+    user_data = get_user(username)
+    if user_data is not None:
+        image_settings = user_data.get("image_generation", {"enabled": True, "daily_limit": 10, "usage_count": 0,
                                                                   "last_reset": datetime.now().strftime("%Y-%m-%d")})
 
         today = datetime.now().strftime("%Y-%m-%d")
@@ -286,24 +841,26 @@ def increment_image_usage(username):
             image_settings["last_reset"] = today
 
         image_settings["usage_count"] = image_settings.get("usage_count", 0) + 1
-        users[username]["image_generation"] = image_settings
-        save_users(users)
+        user_data["image_generation"] = image_settings
+        save_user(username, user_data)
 
 
 def save_admin_settings(settings):
     try:
         if not os.path.exists("database"):
             os.makedirs("database")
-        with open("database/admin_settings.json", "w") as f:
+        with open(ADMIN_SETTINGS_FILE, "w") as f:
             json.dump(settings, f, indent=2)
+        cache = get_admin_settings_cache()
+        with cache["lock"]:
+            cache["settings"] = copy.deepcopy(settings)
+            cache["stamp"] = get_admin_settings_stamp()
     except Exception:
         pass
 
 
 def save_session_data():
     try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
         device_fingerprint = get_device_fingerprint()
         session_data = {
             "authenticated": st.session_state.get("authenticated", False),
@@ -313,9 +870,16 @@ def save_session_data():
             "last_access": datetime.now().isoformat(),
             "session_id": str(uuid4())
         }
-        session_file = f"database/session_{device_fingerprint}.json"
-        with open(session_file, "w") as f:
-            json.dump(session_data, f)
+        conn = get_db_connection()
+        with conn:
+            conn.execute(
+                """INSERT INTO device_sessions (fingerprint, current_user, last_access, data) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (fingerprint) DO UPDATE SET
+                       current_user = excluded.current_user,
+                       last_access = excluded.last_access,
+                       data = excluded.data""",
+                (device_fingerprint, session_data["current_user"], session_data["last_access"],
+                 json.dumps(session_data)))
 
         st.session_state.session_saved = True
     except Exception:
@@ -324,15 +888,12 @@ def save_session_data():
 
 def load_session_data():
     try:
-        if not os.path.exists("database"):
-            os.makedirs("database")
-
         device_fingerprint = get_device_fingerprint()
-        session_file = f"database/session_{device_fingerprint}.json"
+        row = get_db_connection().execute("SELECT data FROM device_sessions WHERE fingerprint = ?",
+                                          (device_fingerprint,)).fetchone()
 
-        if os.path.exists(session_file):
-            with open(session_file, "r") as f:
-                session_data = json.load(f)
+        if row is not None:
+            session_data = json.loads(row["data"])
 
             stored_fingerprint = session_data.get("device_fingerprint", "")
             last_access = session_data.get("last_access", "")
@@ -341,7 +902,7 @@ def load_session_data():
                 if last_access:
                     access_time = datetime.fromisoformat(last_access.replace('Z', '+00:00'))
                     if (datetime.now() - access_time).total_seconds() > 86400:
-                        os.remove(session_file)
+                        delete_session_data(device_fingerprint)
                         st.session_state.authenticated = False
                         st.session_state.current_user = None
                         st.session_state.is_admin = False
@@ -357,10 +918,7 @@ def load_session_data():
                 st.session_state.authenticated = False
                 st.session_state.current_user = None
                 st.session_state.is_admin = False
-                try:
-                    os.remove(session_file)
-                except:
-                    pass
+                delete_session_data(device_fingerprint)
         else:
             st.session_state.authenticated = False
             st.session_state.current_user = None
@@ -372,10 +930,10 @@ def load_session_data():
 
 
 def authorize_device_for_user(username, device_fingerprint):
-    users = load_users()
-    if username in users:
-        if "authorized_devices" not in users[username]:
-            users[username]["authorized_devices"] = []
+    user_data = get_user(username)
+    if user_data is not None:
+        if "authorized_devices" not in user_data:
+            user_data["authorized_devices"] = []
 
         device_info = {
             "fingerprint": device_fingerprint,
@@ -383,28 +941,25 @@ def authorize_device_for_user(username, device_fingerprint):
             "last_used": datetime.now().isoformat()
         }
 
-        existing_device = None
-        for i, device in enumerate(users[username]["authorized_devices"]):
-            if device["fingerprint"] == device_fingerprint:
-                existing_device = i
-                break
+        directory = load_user_directory()
+        with directory["lock"]:
+            existing_device = directory["device_index"].get(device_fingerprint, {}).get(username)
 
-        if existing_device is not None:
-            users[username]["authorized_devices"][existing_device]["last_used"] = datetime.now().isoformat()
+        if existing_device is not None and existing_device < len(user_data["authorized_devices"]):
+            user_data["authorized_devices"][existing_device]["last_used"] = datetime.now().isoformat()
         else:
-            users[username]["authorized_devices"].append(device_info)
+            user_data["authorized_devices"].append(device_info)
 
-        save_users(users)
+        save_user(username, user_data)
 
 
 def is_device_authorized(username, device_fingerprint):
-    users = load_users()
-    if username in users:
-        authorized_devices = users[username].get("authorized_devices", [])
-        for device in authorized_devices:
-            if device["fingerprint"] == device_fingerprint:
-                return True
-    return False
+    try:
+        directory = load_user_directory()
+        with directory["lock"]:
+            return username in directory["device_index"].get(device_fingerprint, {})
+    except Exception:
+        return False
 
 
 def check_authentication():
@@ -425,12 +980,7 @@ def check_authentication():
             st.session_state.authenticated = False
             st.session_state.current_user = None
             st.session_state.is_admin = False
-            try:
-                session_file = f"database/session_{device_fingerprint}.json"
-                if os.path.exists(session_file):
-                    os.remove(session_file)
-            except:
-                pass
+            delete_session_data(device_fingerprint)
             return False
 
     return st.session_state.authenticated
@@ -494,10 +1044,9 @@ def login_form():
 
                 if signup_button:
                     if new_name and new_email and new_username and new_password:
-                        users = load_users()
-                        if new_username not in users:
+                        if get_user(new_username) is None:
                             device_fingerprint = get_device_fingerprint()
-                            users[new_username] = {
+                            save_user(new_username, {
                                 "name": new_name,
                                 "email": new_email,
                                 "password": new_password,
@@ -513,8 +1062,7 @@ def login_form():
                                     "usage_count": 0,
                                     "last_reset": datetime.now().strftime("%Y-%m-%d")
                                 }
-                            }
-                            save_users(users)
+                            })
                             st.session_state.authenticated = True
                             st.session_state.current_user = new_username
                             st.session_state.is_admin = False
@@ -551,12 +1099,7 @@ def logout():
     st.session_state.authenticated = False
     st.session_state.current_user = None
     st.session_state.is_admin = False
-    try:
-        session_file = f"database/session_{device_fingerprint}.json"
-        if os.path.exists(session_file):
-            os.remove(session_file)
-    except Exception:
-        pass
+    delete_session_data(device_fingerprint)
 
     for key in list(st.session_state.keys()):
         if key.startswith('device_fingerprint_'):
@@ -572,21 +1115,34 @@ def save_data_to_file():
     if "current_user" not in st.session_state:
         return
 
-    if not os.path.exists("database"):
-        os.makedirs("database")
-    user_data_file = f"database/catgpt_data_{st.session_state.current_user}.json"
     data_to_save = {
-        "chat_history": st.session_state.get("chat_history", []),
-        "chat_sessions": st.session_state.get("chat_sessions", {}),
+        "chat_history": list(st.session_state.get("chat_history", [])),
+        "chat_sessions": {session_id: dict(session)
+                          for session_id, session in st.session_state.get("chat_sessions", {}).items()},
         "current_session_id": st.session_state.get("current_session_id", str(uuid4())),
         "model": st.session_state.get("model", "gpt-4o-mini"),
         "total_tokens": st.session_state.get("total_tokens", 0),
-        "message_count": st.session_state.get("message_count", 0)
+        "message_count": st.session_state.get("message_count", 0),
+        "rolling_summary": st.session_state.get("rolling_summary")
     }
 
     try:
-        with open(user_data_file, "w") as f:
-            json.dump(data_to_save, f, indent=2)
+        signature = get_user_data_signature(data_to_save)
+        session_signatures = {session_id: get_session_signature(session)
+                              for session_id, session in data_to_save["chat_sessions"].items()}
+        persisted = st.session_state.get("persisted_data_signature")
+        if persisted is not None and persisted[0] == st.session_state.current_user:
+            if persisted[1] == signature and persisted[2] == session_signatures:
+                return
+            dirty_sessions = {session_id for session_id, session_signature in session_signatures.items()
+                              if persisted[2].get(session_id) != session_signature}
+        else:
+            dirty_sessions = set(session_signatures)
+
+        queue_user_data_write(st.session_state.current_user, data_to_save, dirty_sessions)
+        index_session_messages(st.session_state.current_user, data_to_save["current_session_id"],
+                               data_to_save["chat_history"])
+        st.session_state.persisted_data_signature = (st.session_state.current_user, signature, session_signatures)
     except Exception as e:
         pass
 
@@ -595,20 +1151,21 @@ def load_data_from_file():
     if "current_user" not in st.session_state:
         return
 
-    if not os.path.exists("database"):
-        os.makedirs("database")
-    user_data_file = f"database/catgpt_data_{st.session_state.current_user}.json"
     try:
-        if os.path.exists(user_data_file):
-            with open(user_data_file, "r") as f:
-                data = json.load(f)
-
+        data = read_user_data(st.session_state.current_user)
+        if data is not None:
             st.session_state.chat_history = data.get("chat_history", [])
             st.session_state.chat_sessions = data.get("chat_sessions", {})
             st.session_state.current_session_id = data.get("current_session_id", str(uuid4()))
             st.session_state.model = data.get("model", "gpt-4o-mini")
             st.session_state.total_tokens = data.get("total_tokens", 0)
             st.session_state.message_count = data.get("message_count", 0)
+            st.session_state.rolling_summary = data.get("rolling_summary")
+            st.session_state.persisted_data_signature = (
+                st.session_state.current_user,
+                get_user_data_signature(data),
+                {session_id: get_session_signature(session) for session_id, session in data["chat_sessions"].items()}
+            )
     except Exception as e:
         pass
 
@@ -634,7 +1191,6 @@ def admin_panel():
             if st.form_submit_button("Update API Key"):
                 admin_settings["api_key"] = new_api_key
                 save_admin_settings(admin_settings)
-                openai.api_key = new_api_key
                 st.success("API Key updated successfully!")
                 st.rerun()
 
@@ -643,6 +1199,92 @@ def admin_panel():
         else:
             st.error("No API Key configured")
 
+        st.markdown("---")
+        st.subheader("OpenAI Connection Settings")
+        client_settings = dict(OPENAI_CLIENT_DEFAULTS, **admin_settings.get("openai_client", {}))
+
+        with st.form("openai_client_form"):
+            max_connections = st.number_input("Max pooled connections", min_value=1, max_value=200,
+                                              value=int(client_settings["max_connections"]))
+            connect_timeout = st.number_input("Connect timeout (seconds)", min_value=1, max_value=60,
+                                              value=int(client_settings["connect_timeout"]))
+            read_timeout = st.number_input("Read timeout (seconds)", min_value=5, max_value=600,
+                                           value=int(client_settings["read_timeout"]))
+            max_retries = st.number_input("Max retries", min_value=0, max_value=10,
+                                          value=int(client_settings["max_retries"]),
+                                          help="Retries for rate limits and server errors, with exponential backoff")
+            max_in_flight = st.number_input("Max concurrent requests", min_value=1, max_value=100,
+                                            value=int(client_settings["max_in_flight"]),
+                                            help="Further requests wait in a per-user round-robin queue")
+            if st.form_submit_button("Update Connection Settings"):
+                admin_settings["openai_client"] = {
+                    "max_connections": max_connections,
+                    "connect_timeout": connect_timeout,
+                    "read_timeout": read_timeout,
+                    "max_retries": max_retries,
+                    "max_in_flight": max_in_flight
+                }
+                save_admin_settings(admin_settings)
+                st.success("Connection settings updated!")
+
+        resilience = get_openai_resilience()
+        col1_retry, col2_retry, col3_retry, col4_retry = st.columns(4)
+        with col1_retry:
+            st.metric("API Requests", resilience["requests"])
+        with col2_retry:
+            st.metric("Retries", resilience["retries"])
+        with col3_retry:
+            st.metric("Failed Requests", resilience["failed"])
+        with col4_retry:
+            st.metric("Fast-failed", resilience["short_circuited"])
+        if time.time() < resilience["open_until"]:
+            st.warning(f"Circuit open after {resilience['consecutive_failures']} consecutive failures; "
+                       f"requests fail fast for {int(resilience['open_until'] - time.time())} more seconds")
+
+        st.markdown("---")
+        st.subheader("Response Cache")
+        cache_settings = dict(RESPONSE_CACHE_DEFAULTS, **admin_settings.get("response_cache", {}))
+
+        with st.form("response_cache_form"):
+            cache_enabled = st.checkbox("Reuse answers for identical requests", value=cache_settings["enabled"],
+                                        help="Same model, system prompt and conversation context")
+            cache_ttl = st.number_input("Cache lifetime (seconds)", min_value=60, max_value=604800,
+                                        value=int(cache_settings["ttl"]))
+            cache_max_entries = st.number_input("Max cached answers", min_value=10, max_value=10000,
+                                                value=int(cache_settings["max_entries"]))
+            cache_near_duplicates = st.checkbox("Also reuse answers for near-identical first questions",
+                                                value=cache_settings["near_duplicates"],
+                                                help="Only applies to the first message of a chat with no other context")
+            cache_similarity_threshold = st.slider(
+                "Similarity threshold", min_value=NEAR_DUPLICATE_MIN_THRESHOLD, max_value=1.0, step=0.01,
+                value=max(NEAR_DUPLICATE_MIN_THRESHOLD, float(cache_settings["similarity_threshold"])))
+            if st.form_submit_button("Update Cache Settings"):
+                admin_settings["response_cache"] = {
+                    "enabled": cache_enabled,
+                    "ttl": cache_ttl,
+                    "max_entries": cache_max_entries,
+                    "near_duplicates": cache_near_duplicates,
+                    "similarity_threshold": cache_similarity_threshold
+                }
+                save_admin_settings(admin_settings)
+                st.success("Response cache settings updated!")
+
+        response_cache = get_response_cache()
+        similar_response_cache = get_similar_response_cache()
+        col1_cache, col2_cache, col3_cache, col4_cache = st.columns(4)
+        with col1_cache:
+            st.metric("Cache Hits", response_cache["hits"])
+        with col2_cache:
+            st.metric("Cache Misses", response_cache["misses"])
+        with col3_cache:
+            st.metric("Near-duplicate Hits", similar_response_cache["hits"])
+        with col4_cache:
+            st.metric("Cached Answers", len(response_cache["entries"]))
+        if st.button("Clear Response Cache"):
+            clear_response_cache()
+            st.success("Response cache cleared!")
+            st.rerun()
+
     with tab2:
         st.subheader("User Management")
 
@@ -713,15 +1355,7 @@ def admin_panel():
                         st.error("🔴 Blocked")
 
                 with col3:
-                    user_data_file = f"database/catgpt_data_{username}.json"
-                    current_model = "gpt-4o-mini"
-                    if os.path.exists(user_data_file):
-                        try:
-                            with open(user_data_file, "r") as f:
-                                data = json.load(f)
-                            current_model = data.get("model", "gpt-4o-mini")
-                        except:
-                            pass
+                    current_model = read_user_model(username)
 
                     new_model = st.selectbox(
                         "Model",
@@ -731,36 +1365,29 @@ def admin_panel():
                     )
 
                     if new_model != current_model:
-                        try:
-                            if os.path.exists(user_data_file):
-                                with open(user_data_file, "r") as f:
-                                    data = json.load(f)
-                                data["model"] = new_model
-                                with open(user_data_file, "w") as f:
-                                    json.dump(data, f, indent=2)
-                        except:
-                            pass
+                        update_user_model(username, new_model)
 
                 with col4:
                     if user_data.get('status', 'active') == 'active':
                         if st.button("Block", key=f"block_{username}"):
-                            users[username]['status'] = 'blocked'
-                            save_users(users)
+                            user = get_user(username)
+                            if user is not None:
+                                user['status'] = 'blocked'
+                                save_user(username, user)
                             st.rerun()
                     else:
                         if st.button("Unblock", key=f"unblock_{username}"):
-                            users[username]['status'] = 'active'
-                            save_users(users)
+                            user = get_user(username)
+                            if user is not None:
+                                user['status'] = 'active'
+                                save_user(username, user)
                             st.rerun()
 
                 with col5:
                     if st.button("Delete", key=f"delete_{username}"):
-                        del users[username]
-                        save_users(users)
+                        delete_user(username)
                         try:
-                            user_file = f"database/catgpt_data_{username}.json"
-                            if os.path.exists(user_file):
-                                os.remove(user_file)
+                            delete_user_data(username)
                         except:
                             pass
                         st.rerun()
@@ -784,8 +1411,10 @@ def admin_panel():
                             key=f"img_enabled_{username}"
                         )
                         if image_enabled != image_settings.get("enabled", True):
-                            users[username]["image_generation"]["enabled"] = image_enabled
-                            save_users(users)
+                            user = get_user(username)
+                            if user is not None:
+                                user.setdefault("image_generation", image_settings)["enabled"] = image_enabled
+                                save_user(username, user)
                             st.rerun()
 
                 with col2_img:
@@ -801,8 +1430,10 @@ def admin_panel():
                             key=f"img_limit_{username}"
                         )
                         if daily_limit != image_settings.get("daily_limit", 10):
-                            users[username]["image_generation"]["daily_limit"] = daily_limit
-                            save_users(users)
+                            user = get_user(username)
+                            if user is not None:
+                                user.setdefault("image_generation", image_settings)["daily_limit"] = daily_limit
+                                save_user(username, user)
                             st.rerun()
 
                 with col3_img:
@@ -813,23 +1444,21 @@ def admin_panel():
                         st.button("Reset Count", disabled=True, key=f"disabled_reset_{username}")
                     else:
                         if st.button("Reset Count", key=f"reset_img_{username}"):
-                            users[username]["image_generation"]["usage_count"] = 0
-                            users[username]["image_generation"]["last_reset"] = datetime.now().strftime("%Y-%m-%d")
-                            save_users(users)
+                            user = get_user(username)
+                            if user is not None:
+                                image_generation = user.setdefault("image_generation", image_settings)
+                                image_generation["usage_count"] = 0
+                                image_generation["last_reset"] = datetime.now().strftime("%Y-%m-%d")
+                                save_user(username, user)
                             st.rerun()
 
                 if st.button(f"Reset Devices for {username}", key=f"reset_devices_{username}"):
-                    users[username]['authorized_devices'] = []
-                    save_users(users)
+                    user = get_user(username)
+                    if user is not None:
+                        user['authorized_devices'] = []
+                        save_user(username, user)
 
-                    for session_file in glob.glob(f"database/session_*.json"):
-                        try:
-                            with open(session_file, 'r') as f:
-                                session_data = json.load(f)
-                            if session_data.get('current_user') == username:
-                                os.remove(session_file)
-                        except:
-                            pass
+                    delete_session_data(username=username)
 
                     st.success(f"All authorized devices cleared for {username}")
                     st.rerun()
@@ -853,11 +1482,11 @@ def admin_panel():
             save_admin_settings(admin_settings)
             st.success("Global chat refresh interval updated!")
 
-        global_messages = load_global_chat()
+        global_messages = load_global_chat(limit=10)
 
         col1_global, col2_global = st.columns([1, 1])
         with col1_global:
-            st.metric("Total Global Messages", len(global_messages))
+            st.metric("Total Global Messages", count_global_chat_messages())
         with col2_global:
             if st.button("Clear Global Chat", type="secondary"):
                 clear_global_chat()
@@ -888,13 +1517,14 @@ def admin_panel():
         selected_user = st.selectbox("Select User", list(users.keys()))
 
         if selected_user:
-            user_data_file = f"database/catgpt_data_{selected_user}.json"
+            try:
+                user_data = read_user_data(selected_user)
+            except Exception as e:
+                user_data = None
+                st.error(f"Error loading chat data: {str(e)}")
 
-            if os.path.exists(user_data_file):
+            if user_data is not None:
                 try:
-                    with open(user_data_file, "r") as f:
-                        user_data = json.load(f)
-
                     chat_history = user_data.get("chat_history", [])
                     chat_sessions = user_data.get("chat_sessions", {})
 
@@ -920,7 +1550,7 @@ def admin_panel():
                             st.write(f"**Messages:** {session_data.get('message_count', 0)}")
 
                             st.subheader("Messages")
-                            for msg in session_data.get('messages', []):
+                            for msg in read_session_messages(selected_user, session_id):
                                 with st.chat_message(msg["role"]):
                                     if msg["content"].startswith("![Generated Image](http"):
                                         url = msg["content"].split("(")[1].rstrip(")")
@@ -952,7 +1582,7 @@ def admin_panel():
 
                     if st.button(f"Delete {selected_user}'s Chat Data"):
                         try:
-                            os.remove(user_data_file)
+                            delete_user_data(selected_user)
                             st.success(f"Chat data for {selected_user} has been deleted!")
                             st.rerun()
                         except:
@@ -1003,6 +1633,18 @@ def admin_panel():
             save_admin_settings(admin_settings)
             st.success("Memory settings updated!")
 
+        retrieval_top_k = st.slider(
+            "Past conversation snippets",
+            min_value=0,
+            max_value=10,
+            value=admin_settings["memory_settings"].get("retrieval_top_k", SEARCH_TOP_K),
+            help="Number of relevant messages from older sessions to include with each request"
+        )
+        if retrieval_top_k != admin_settings["memory_settings"].get("retrieval_top_k", SEARCH_TOP_K):
+            admin_settings["memory_settings"]["retrieval_top_k"] = retrieval_top_k
+            save_admin_settings(admin_settings)
+            st.success("Memory settings updated!")
+
         st.markdown("---")
         st.write("**Custom Team & Organization Data**")
         custom_data = st.text_area(
@@ -1015,6 +1657,7 @@ def admin_panel():
         if custom_data != admin_settings.get("custom_data", ""):
             admin_settings["custom_data"] = custom_data
             save_admin_settings(admin_settings)
+            get_custom_data_index(custom_data)
             st.success("Custom data updated!")
 
         st.markdown("---")
@@ -1115,6 +1758,93 @@ def admin_panel():
         with col2_reset:
             st.caption("This will reset all app configuration to original CatGPT settings")
 
+        st.markdown("---")
+        st.markdown("**Streaming**")
+        stream_flush_interval = st.slider(
+            "Response refresh interval (seconds)",
+            min_value=0.05,
+            max_value=1.0,
+            step=0.05,
+            value=float(admin_settings.get("stream_flush_interval", STREAM_FLUSH_INTERVAL)),
+            help="How often a streaming reply is redrawn while it is being generated"
+        )
+        if stream_flush_interval != admin_settings.get("stream_flush_interval", STREAM_FLUSH_INTERVAL):
+            admin_settings["stream_flush_interval"] = stream_flush_interval
+            save_admin_settings(admin_settings)
+            st.success("Streaming refresh interval updated!")
+
+
+@st.cache_resource
+def get_global_chat_html_cache():
+    return {"lock": threading.Lock(), "fragments": OrderedDict()}
+
+
+def format_global_chat_message(message, is_current_user):
+    row_class = "message-row-right" if is_current_user else "message-row-left"
+    content = html.escape(message.get("content", "")).replace("\n", "<br>")
+    timestamp = html.escape(message.get("timestamp", ""))
+    return (f'<div class="{row_class}"><div class="message-content"><div>{content}</div>'
+            f'<div class="message-time">🕐 {timestamp}</div></div></div>')
+
+
+def get_global_chat_message_html(message, is_current_user):
+    message_id = message.get("message_id")
+    if not message_id:
+        return format_global_chat_message(message, is_current_user)
+
+    cache = get_global_chat_html_cache()
+    key = (message_id, is_current_user)
+    with cache["lock"]:
+        fragment = cache["fragments"].get(key)
+        if fragment is not None:
+            cache["fragments"].move_to_end(key)
+            return fragment
+
+    fragment = format_global_chat_message(message, is_current_user)
+    with cache["lock"]:
+        cache["fragments"][key] = fragment
+        while len(cache["fragments"]) > 2 * GLOBAL_CHAT_RETENTION:
+            cache["fragments"].popitem(last=False)
+    return fragment
+
+
+def render_global_chat_messages(current_user):
+    version = get_global_chat_version()
+    view = st.session_state.get("global_chat_view")
+    if view is None or view["version"][0] != version[0]:
+        view = {"version": (version[0], 0), "messages": [], "count": 0}
+
+    if version != view["version"]:
+        for seq, message in load_global_chat_since(view["version"][1], limit=50):
+            view["messages"].append(message)
+        view["messages"] = view["messages"][-50:]
+        view["version"] = version
+        view["count"] = count_global_chat_messages()
+        view["html"] = None
+    if view.get("html") is None:
+        view["html"] = ('<div class="chat-container">' +
+                        "".join(get_global_chat_message_html(message, message.get("user_id", "") == current_user)
+                                for message in view["messages"]) +
+                        "</div><div style='height: 20px;'></div>")
+    st.session_state.global_chat_view = view
+
+    global_messages = view["messages"]
+
+    if global_messages:
+        st.subheader("Global Conversation")
+
+        col1_status, col2_status = st.columns([2, 1])
+        with col1_status:
+            st.info(f" {view['count']} messages •Auto-refresh: ON")
+        with col2_status:
+            current_time_str = datetime.now().strftime("%H:%M:%S")
+            st.caption(f"Last update: {current_time_str}")
+
+        st.markdown(view["html"], unsafe_allow_html=True)
+    else:
+        st.markdown("Welcome to Global Chat!")
+        st.markdown("- Chat with all logged-in users")
+
 
 def global_chat_interface():
     admin_settings = load_admin_settings()
@@ -1202,65 +1932,9 @@ def global_chat_interface():
     </style>
     """, unsafe_allow_html=True)
 
-    if "global_auto_refresh" not in st.session_state:
-        st.session_state.global_auto_refresh = True
-
-    if "last_global_check" not in st.session_state:
-        st.session_state.last_global_check = time.time()
-
-    current_time = time.time()
-    time_since_last_check = current_time - st.session_state.last_global_check
-
-    if time_since_last_check >= refresh_interval:
-        st.session_state.last_global_check = current_time
-        st.rerun()
-
-    global_messages = load_global_chat()
     current_user = st.session_state.get("current_user", "")
+    st.fragment(render_global_chat_messages, run_every=refresh_interval)(current_user)
 
-    if global_messages:
-        st.subheader("Global Conversation")
-
-        col1_status, col2_status = st.columns([2, 1])
-        with col1_status:
-            st.info(f" {len(global_messages)} messages •Auto-refresh: ON")
-        with col2_status:
-            current_time_str = datetime.now().strftime("%H:%M:%S")
-            st.caption(f"Last update: {current_time_str}")
-
-        st.markdown('<div class="chat-container">', unsafe_allow_html=True)
-
-        for message in global_messages[-50:]:
-            content = message.get("content", "")
-            timestamp = message.get("timestamp", "")
-            message_user = message.get("user_id", "")
-
-            is_current_user = (message_user == current_user)
-
-            if is_current_user:
-                st.markdown(f"""
-                <div class="message-row-right">
-                    <div class="message-content">
-                        <div>{content}</div>
-                        <div class="message-time">🕐 {timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="message-row-left">
-                    <div class="message-content">
-                        <div>{content}</div>
-                        <div class="message-time">🕐 {timestamp}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-
-        st.markdown('</div>', unsafe_allow_html=True)
-        st.markdown("<div style='height: 20px;'></div>", unsafe_allow_html=True)
-    else:
-        st.markdown("Welcome to Global Chat!")
-        st.markdown("- Chat with all logged-in users")
     if global_prompt := st.chat_input("Type your message to the global chat..."):
         user_message = {
             "role": "user",
@@ -1271,12 +1945,8 @@ def global_chat_interface():
         }
 
         save_global_chat_message(user_message)
-        st.session_state.last_global_check = time.time()
         st.rerun()
 
-    time.sleep(refresh_interval)
-    st.rerun()
-
 
 def initialize_session_state():
     admin_settings = load_admin_settings()
@@ -1318,14 +1988,15 @@ def detect_image_request(prompt):
     return any(keyword in prompt_lower for keyword in image_keywords)
 
 
-def generate_dalle_image(prompt):
+def generate_dalle_image(prompt, on_wait=None):
     try:
-        response = openai.images.generate(
+        client = get_client()
+        response = run_with_request_slot(st.session_state.current_user, lambda: client.images.generate(
             model="dall-e-3",
             prompt=prompt,
             size="1024x1024",
             n=1,
-        )
+        ), on_wait)
 
         image_url = response.data[0].url
         return image_url
@@ -1440,13 +2111,22 @@ def load_custom_css():
 st.markdown(load_custom_css(), unsafe_allow_html=True)
 
 
+@st.cache_resource
+def get_token_encoder(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return None
+
+
 def get_token_count(text, model="gpt-4"):
     if TIKTOKEN_AVAILABLE:
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-            return len(encoding.encode(text))
-        except Exception:
-            pass
+        encoding = get_token_encoder(model)
+        if encoding is not None:
+            try:
+                return len(encoding.encode(text))
+            except Exception:
+                pass
 
     word_count = len(text.split())
     char_count = len(text)
@@ -1455,19 +2135,230 @@ def get_token_count(text, model="gpt-4"):
     return max(token_estimate_words, token_estimate_chars)
 
 
+def get_message_token_count(message):
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = get_token_count(message["content"])
+        message["tokens"] = tokens
+    return tokens
+
+
 def get_conversation_token_count(messages):
     total_tokens = 0
     for message in messages:
-        total_tokens += get_token_count(message["content"])
+        total_tokens += get_message_token_count(message)
     return int(total_tokens)
 
 
+@st.cache_resource
+def get_openai_client(api_key, max_connections, connect_timeout, read_timeout):
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                            keepalive_expiry=60),
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+    )
+    return openai.OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
+
+def get_client():
+    admin_settings = load_admin_settings()
+    client_settings = dict(OPENAI_CLIENT_DEFAULTS, **admin_settings.get("openai_client", {}))
+    return get_openai_client(
+        admin_settings.get("api_key", st.secrets.get("OPENAI_API_KEY", "")),
+        int(client_settings["max_connections"]),
+        float(client_settings["connect_timeout"]),
+        float(client_settings["read_timeout"])
+    )
+
+
+@st.cache_resource
+def get_openai_resilience():
+    return {"lock": threading.Lock(), "consecutive_failures": 0, "open_until": 0, "requests": 0, "retries": 0,
+            "failed": 0, "short_circuited": 0}
+
+
+def is_retryable_error(error):
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code in (408, 409, 429) or (status_code is not None and status_code >= 500)
+
+
+def get_retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        pass
+    return None
+
+
+def call_with_retries(function):
+    client_settings = dict(OPENAI_CLIENT_DEFAULTS, **load_admin_settings().get("openai_client", {}))
+    max_retries = int(client_settings["max_retries"])
+    resilience = get_openai_resilience()
+
+    attempt = 0
+    while True:
+        with resilience["lock"]:
+            remaining = resilience["open_until"] - time.time()
+            if remaining > 0:
+                resilience["short_circuited"] += 1
+            else:
+                resilience["requests"] += 1
+        if remaining > 0:
+            raise Exception(f"OpenAI is temporarily unavailable, please try again in {int(remaining) + 1} seconds")
+
+        try:
+            result = function()
+        except Exception as e:
+            if not is_retryable_error(e):
+                raise
+            with resilience["lock"]:
+                resilience["consecutive_failures"] += 1
+                if resilience["consecutive_failures"] >= CIRCUIT_BREAKER_THRESHOLD:
+                    resilience["open_until"] = time.time() + CIRCUIT_BREAKER_COOLDOWN
+                if attempt >= max_retries or time.time() < resilience["open_until"]:
+                    resilience["failed"] += 1
+                    raise
+                resilience["retries"] += 1
+
+            delay = get_retry_after(e)
+            if delay is None:
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1)
+            time.sleep(min(delay, RETRY_MAX_DELAY))
+            attempt += 1
+            continue
+
+        with resilience["lock"]:
+            resilience["consecutive_failures"] = 0
+        return result
+
+
+def open_stream(create_stream):
+    stream = iter(create_stream())
+    first_chunk = next(stream, None)
+
+    def chunks():
+        if first_chunk is not None:
+            yield first_chunk
+        yield from stream
+    return chunks()
+
+
+@st.cache_resource
+def get_request_scheduler():
+    return {"condition": threading.Condition(), "limit": OPENAI_CLIENT_DEFAULTS["max_in_flight"], "active": 0,
+            "queues": OrderedDict()}
+
+
+def dispatch_request_slots(scheduler):
+    while scheduler["active"] < scheduler["limit"] and scheduler["queues"]:
+        lane, queue = next(iter(scheduler["queues"].items()))
+        ticket = queue.popleft()
+        if queue:
+            scheduler["queues"].move_to_end(lane)
+        else:
+            del scheduler["queues"][lane]
+        ticket["granted"] = True
+        scheduler["active"] += 1
+    scheduler["condition"].notify_all()
+
+
+def get_queue_position(scheduler, ticket):
+    own_queue = scheduler["queues"][ticket["lane"]]
+    index = next(index for index, queued in enumerate(own_queue) if queued is ticket)
+    position = index + 1
+    ahead = True
+    for lane, queue in scheduler["queues"].items():
+        if lane == ticket["lane"]:
+            ahead = False
+        else:
+            position += min(len(queue), index + 1 if ahead else index)
+    return position
+
+
+def remove_request_ticket(scheduler, ticket):
+    queue = scheduler["queues"].get(ticket["lane"])
+    if queue is not None:
+        scheduler["queues"][ticket["lane"]] = deque(queued for queued in queue if queued is not ticket)
+        if not scheduler["queues"][ticket["lane"]]:
+            del scheduler["queues"][ticket["lane"]]
+
+
+def acquire_request_slot(lane, on_wait=None):
+    client_settings = dict(OPENAI_CLIENT_DEFAULTS, **load_admin_settings().get("openai_client", {}))
+    scheduler = get_request_scheduler()
+    ticket = {"lane": lane, "granted": False}
+    reported = None
+
+    with scheduler["condition"]:
+        scheduler["limit"] = int(client_settings["max_in_flight"])
+        scheduler["queues"].setdefault(lane, deque()).append(ticket)
+        dispatch_request_slots(scheduler)
+
+    try:
+        while True:
+            with scheduler["condition"]:
+                if ticket["granted"]:
+                    break
+                position = get_queue_position(scheduler, ticket)
+                if position == reported or on_wait is None:
+                    scheduler["condition"].wait()
+                    continue
+            on_wait(position)
+            reported = position
+
+        if reported is not None:
+            on_wait(None)
+    except BaseException:
+        with scheduler["condition"]:
+            if ticket["granted"]:
+                scheduler["active"] -= 1
+            else:
+                remove_request_ticket(scheduler, ticket)
+            dispatch_request_slots(scheduler)
+        raise
+
+
+def release_request_slot():
+    scheduler = get_request_scheduler()
+    with scheduler["condition"]:
+        scheduler["active"] -= 1
+        dispatch_request_slots(scheduler)
+
+
+def run_with_request_slot(lane, function, on_wait=None):
+    acquire_request_slot(lane, on_wait)
+    try:
+        return call_with_retries(function)
+    finally:
+        release_request_slot()
+
+
+def get_queue_notifier(placeholder):
+    def notify(position):
+        if position:
+            placeholder.caption(f"⏳ Waiting in queue: position {position}")
+        else:
+            placeholder.empty()
+    return notify
+
+
 admin_settings = load_admin_settings()
 api_key = admin_settings.get("api_key", st.secrets.get("OPENAI_API_KEY", ""))
 
 try:
-    openai.api_key = api_key
-    if not openai.api_key:
+    if not api_key:
         st.error("OpenAI API key not found. Please contact admin to configure the API key.")
         st.stop()
 except Exception as e:
@@ -1475,10 +2366,7 @@ except Exception as e:
     st.stop()
 
 
-def create_conversation_summary(messages):
-    if len(messages) < 3:
-        return ""
-
+def request_conversation_summary(messages):
     conversation_text = ""
     for msg in messages[-10:]:
         if msg["role"] != "system":
@@ -1490,26 +2378,709 @@ def create_conversation_summary(messages):
         {"role": "user", "content": f"Summarize this conversation:\n{conversation_text}"}
     ]
 
+    client = get_client()
+    response = run_with_request_slot(SUMMARY_REQUEST_LANE, lambda: client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=summary_messages,
+        max_tokens=100,
+        temperature=0.3
+    ))
+    return response.choices[0].message.content.strip()
+
+
+def summarize_conversation_keywords(messages):
+    topics = []
+    for msg in messages[-5:]:
+        if msg["role"] == "user" and len(msg["content"]) > 10:
+            words = msg["content"].split()[:8]
+            topics.append(" ".join(words))
+    if topics:
+        return f"Previous discussion about: {', '.join(topics[:2])}"
+    return "Previous conversation context available"
+
+
+@st.cache_resource
+def get_single_flight_calls():
+    return {"lock": threading.Lock(), "calls": {}}
+
+
+def run_single_flight(key, function, *args):
+    single_flight = get_single_flight_calls()
+    with single_flight["lock"]:
+        future = single_flight["calls"].get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            single_flight["calls"][key] = future
+
+    if not leader:
+        return future.result()
+
     try:
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=summary_messages,
-            max_tokens=100,
-            temperature=0.3
-        )
-        return response.choices[0].message.content.strip()
-    except:
-        topics = []
-        for msg in messages[-5:]:
-            if msg["role"] == "user" and len(msg["content"]) > 10:
-                words = msg["content"].split()[:8]
-                topics.append(" ".join(words))
-        if topics:
-            return f"Previous discussion about: {', '.join(topics[:2])}"
-        return "Previous conversation context available"
-
-
-def manage_conversation_memory(messages):
+        result = function(*args)
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with single_flight["lock"]:
+            single_flight["calls"].pop(key, None)
+
+
+@st.cache_resource
+def get_stream_flights():
+    return {"lock": threading.Lock(), "flights": {}}
+
+
+def set_flight_queue_position(flight, position):
+    with flight["condition"]:
+        flight["queue_position"] = position
+        flight["condition"].notify_all()
+
+
+def pump_stream_flight(flights, key, flight, create_stream, lane):
+    try:
+        acquire_request_slot(lane, lambda position: set_flight_queue_position(flight, position))
+        try:
+            for text in iter_stream_text(call_with_retries(lambda: open_stream(create_stream))):
+                with flight["condition"]:
+                    flight["parts"].append(text)
+                    flight["condition"].notify_all()
+        finally:
+            release_request_slot()
+    except Exception as e:
+        flight["error"] = e
+    finally:
+        with flights["lock"]:
+            flights["flights"].pop(key, None)
+        with flight["condition"]:
+            flight["done"] = True
+            flight["condition"].notify_all()
+
+
+def follow_stream_flight(flight, on_wait=None):
+    position = 0
+    reported = None
+    while True:
+        with flight["condition"]:
+            while position >= len(flight["parts"]) and not flight["done"] and \
+                    flight["queue_position"] == reported:
+                flight["condition"].wait()
+            parts = flight["parts"][position:]
+            done = flight["done"]
+            queue_position = flight["queue_position"]
+        if on_wait is not None and queue_position != reported:
+            on_wait(queue_position)
+        reported = queue_position
+        position += len(parts)
+        for text in parts:
+            yield text
+        if done:
+            if flight["error"] is not None:
+                raise flight["error"]
+            return
+
+
+def stream_single_flight(key, create_stream, lane, on_wait=None):
+    flights = get_stream_flights()
+    with flights["lock"]:
+        flight = flights["flights"].get(key)
+        if flight is None:
+            flight = {"condition": threading.Condition(), "parts": [], "done": False, "error": None,
+                      "queue_position": None}
+            flights["flights"][key] = flight
+            threading.Thread(target=pump_stream_flight,
+                             args=(flights, key, flight, create_stream, lane), daemon=True).start()
+    return follow_stream_flight(flight, on_wait)
+
+
+@st.cache_resource
+def get_summary_cache():
+    return {"lock": threading.Lock(), "summaries": OrderedDict()}
+
+
+def get_messages_hash(messages):
+    return hashlib.sha256(json.dumps([[msg["role"], msg["content"]] for msg in messages]).encode()).hexdigest()
+
+
+def lookup_summary_cache(content_hash):
+    cache = get_summary_cache()
+    with cache["lock"]:
+        summary = cache["summaries"].get(content_hash)
+        if summary is not None:
+            cache["summaries"].move_to_end(content_hash)
+        return summary
+
+
+def store_summary_cache(content_hash, summary):
+    cache = get_summary_cache()
+    with cache["lock"]:
+        cache["summaries"][content_hash] = summary
+        while len(cache["summaries"]) > SUMMARY_CACHE_SIZE:
+            cache["summaries"].popitem(last=False)
+
+
+@st.cache_resource
+def get_response_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "hits": 0, "misses": 0}
+
+
+def get_response_cache_key(model, api_messages, temperature, max_tokens):
+    return hashlib.sha256(json.dumps([model, temperature, max_tokens, api_messages]).encode()).hexdigest()
+
+
+def lookup_response_cache(cache_key, ttl):
+    cache = get_response_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(cache_key)
+        if entry is not None and time.time() - entry[0] > ttl:
+            del cache["entries"][cache_key]
+            entry = None
+        if entry is None:
+            cache["misses"] += 1
+            return None
+        cache["entries"].move_to_end(cache_key)
+        cache["hits"] += 1
+        return entry[1]
+
+
+def store_response_cache(cache_key, response_text, max_entries):
+    cache = get_response_cache()
+    with cache["lock"]:
+        cache["entries"][cache_key] = (time.time(), response_text)
+        cache["entries"].move_to_end(cache_key)
+        while len(cache["entries"]) > max_entries:
+            cache["entries"].popitem(last=False)
+
+
+def clear_response_cache():
+    cache = get_response_cache()
+    with cache["lock"]:
+        cache["entries"].clear()
+        cache["hits"] = 0
+        cache["misses"] = 0
+
+    similar_cache = get_similar_response_cache()
+    with similar_cache["lock"]:
+        similar_cache["entries"].clear()
+        similar_cache["buckets"].clear()
+        similar_cache["hits"] = 0
+        similar_cache["misses"] = 0
+
+
+@st.cache_resource
+def get_similar_response_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "buckets": {}, "next_id": 0, "hits": 0, "misses": 0}
+
+
+@st.cache_resource
+def get_minhash_coefficients():
+    rng = random.Random(MINHASH_PRIME)
+    return [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME)) for _ in range(MINHASH_PERMUTATIONS)]
+
+
+def get_prompt_shingles(prompt):
+    words = sorted(set(SEARCH_TOKEN_PATTERN.findall(prompt.lower())))
+    if not words or len(words) > NEAR_DUPLICATE_MAX_WORDS:
+        return frozenset()
+    words = ["^"] + words + ["$"]
+    return frozenset(zip(words, words[1:]))
+
+
+def get_minhash_band_keys(context_key, shingles):
+    hashes = [int.from_bytes(hashlib.blake2b(" ".join(shingle).encode(), digest_size=8).digest(), "big")
+              for shingle in shingles]
+    signature = [min((a * value + b) % MINHASH_PRIME for value in hashes) for a, b in get_minhash_coefficients()]
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    return [(context_key, band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(MINHASH_BANDS)]
+
+
+def remove_similar_response(cache, entry_id):
+    entry = cache["entries"].pop(entry_id)
+    for band_key in entry["band_keys"]:
+        bucket = cache["buckets"].get(band_key)
+        if bucket is not None:
+            bucket.discard(entry_id)
+            if not bucket:
+                del cache["buckets"][band_key]
+
+
+def lookup_similar_response(context_key, prompt, threshold, ttl):
+    shingles = get_prompt_shingles(prompt)
+    if not shingles:
+        return None
+    band_keys = get_minhash_band_keys(context_key, shingles)
+
+    cache = get_similar_response_cache()
+    with cache["lock"]:
+        candidates = set()
+        for band_key in band_keys:
+            candidates.update(cache["buckets"].get(band_key, ()))
+
+        best = None
+        now = time.time()
+        for entry_id in candidates:
+            entry = cache["entries"][entry_id]
+            if now - entry["created_at"] > ttl:
+                remove_similar_response(cache, entry_id)
+                continue
+            similarity = len(shingles & entry["shingles"]) / len(shingles | entry["shingles"])
+            if similarity >= threshold and (best is None or similarity > best[0]):
+                best = (similarity, entry_id)
+
+        if best is None:
+            cache["misses"] += 1
+            return None
+        cache["entries"].move_to_end(best[1])
+        cache["hits"] += 1
+        return cache["entries"][best[1]]["response"]
+
+
+def store_similar_response(context_key, prompt, response_text, max_entries):
+    shingles = get_prompt_shingles(prompt)
+    if not shingles:
+        return
+    band_keys = get_minhash_band_keys(context_key, shingles)
+
+    cache = get_similar_response_cache()
+    with cache["lock"]:
+        entry_id = cache["next_id"]
+        cache["next_id"] += 1
+        cache["entries"][entry_id] = {"created_at": time.time(), "shingles": shingles, "band_keys": band_keys,
+                                      "response": response_text}
+        for band_key in band_keys:
+            cache["buckets"].setdefault(band_key, set()).add(entry_id)
+        while len(cache["entries"]) > max_entries:
+            remove_similar_response(cache, next(iter(cache["entries"])))
+
+
+def summarize_session(session_data, messages):
+    content_hash = get_messages_hash(messages)
+    if session_data.get("summary_hash") == content_hash and session_data.get("summary") is not None:
+        return session_data["summary"]
+
+    summary = lookup_summary_cache(content_hash)
+    if summary is None:
+        if len(messages) < 3:
+            summary = ""
+        else:
+            try:
+                summary = run_single_flight(("summary", content_hash), request_conversation_summary, messages)
+            except Exception:
+                return summarize_conversation_keywords(messages)
+        store_summary_cache(content_hash, summary)
+
+    session_data["summary"] = summary
+    session_data["summary_hash"] = content_hash
+    return summary
+
+
+@st.cache_resource
+def get_summary_executor():
+    return ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summary")
+
+
+def request_rolling_summary(previous_summary, new_messages):
+    conversation_text = ""
+    for msg in new_messages:
+        if msg["role"] != "system":
+            conversation_text += f"{msg['role']}: {msg['content'][:500]}\n"
+
+    summary_messages = [
+        {"role": "system",
+         "content": "You maintain a running summary of a conversation. Update the existing summary with the new messages, keeping the key topics, facts and decisions needed to continue the discussion in at most 5 sentences."},
+        {"role": "user",
+         "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{conversation_text}"}
+    ]
+
+    client = get_client()
+    response = run_with_request_slot(SUMMARY_REQUEST_LANE, lambda: client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=summary_messages,
+        max_tokens=250,
+        temperature=0.3
+    ))
+    return response.choices[0].message.content.strip()
+
+
+def update_rolling_summary(rolling_summary, old_messages, session_id):
+    covered = (rolling_summary or {}).get("covered", 0)
+    if (rolling_summary is None or rolling_summary.get("session_id") != session_id or covered > len(old_messages) or
+            (covered and rolling_summary.get("boundary_hash") != get_messages_hash(old_messages[covered - 1:covered]))):
+        rolling_summary = {"session_id": session_id, "covered": 0, "boundary_hash": None, "text": ""}
+        covered = 0
+
+    while covered < len(old_messages):
+        end = covered
+        chunk_tokens = 0
+        while end < len(old_messages):
+            message = old_messages[end]
+            message_tokens = get_token_count(message["content"][:500]) if message["role"] != "system" else 0
+            if end > covered and chunk_tokens + message_tokens > ROLLING_SUMMARY_CHUNK_TOKENS:
+                break
+            chunk_tokens += message_tokens
+            end += 1
+        new_messages = old_messages[covered:end]
+        chunk_hash = hashlib.sha256(
+            f"rolling:{rolling_summary['text']}:{get_messages_hash(new_messages)}".encode()).hexdigest()
+
+        text = lookup_summary_cache(chunk_hash)
+        if text is None:
+            try:
+                text = run_single_flight(("rolling", chunk_hash), request_rolling_summary, rolling_summary["text"],
+                                         new_messages)
+            except Exception:
+                fallback = summarize_conversation_keywords(old_messages[covered:])
+                return rolling_summary, f"{rolling_summary['text']} {fallback}".strip()
+            store_summary_cache(chunk_hash, text)
+
+        covered = end
+        rolling_summary = {
+            "session_id": session_id,
+            "covered": covered,
+            "boundary_hash": get_messages_hash(old_messages[covered - 1:covered]),
+            "text": text
+        }
+
+    return rolling_summary, rolling_summary["text"]
+
+
+@st.cache_resource
+def get_search_index():
+    return {"lock": threading.Lock(), "users": {}}
+
+
+def tokenize_search_text(text):
+    return [term for term in SEARCH_TOKEN_PATTERN.findall(text.lower()) if term not in SEARCH_STOPWORDS]
+
+
+def add_search_document(user_index, session_id, text):
+    terms = {}
+    for term in tokenize_search_text(text):
+        terms[term] = terms.get(term, 0) + 1
+    if not terms:
+        return
+
+    doc_id = user_index["next_id"]
+    user_index["next_id"] += 1
+    length = sum(terms.values())
+    user_index["docs"][doc_id] = (session_id, text[:SEARCH_SNIPPET_CHARS], length, terms)
+    user_index["sessions"].setdefault(session_id, []).append(doc_id)
+    user_index["total_length"] += length
+    for term, count in terms.items():
+        user_index["postings"].setdefault(term, {})[doc_id] = count
+
+
+def remove_search_session(user_index, session_id):
+    for doc_id in user_index["sessions"].pop(session_id, []):
+        _, _, length, terms = user_index["docs"].pop(doc_id)
+        user_index["total_length"] -= length
+        for term in terms:
+            postings = user_index["postings"][term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del user_index["postings"][term]
+    user_index["indexed"].pop(session_id, None)
+
+
+def update_search_session(user_index, session_id, messages):
+    indexed = user_index["indexed"].get(session_id, 0)
+    if len(messages) < indexed:
+        remove_search_session(user_index, session_id)
+        indexed = 0
+
+    for message in messages[indexed:]:
+        if message.get("role") in ("user", "assistant") and \
+                not message.get("content", "").startswith("![Generated Image]"):
+            add_search_document(user_index, session_id, message["content"])
+    user_index["indexed"][session_id] = len(messages)
+
+
+def create_search_index():
+    return {"docs": {}, "postings": {}, "sessions": {}, "indexed": {}, "total_length": 0, "next_id": 0}
+
+
+def build_user_search_index(username):
+    user_index = create_search_index()
+    user_data = read_user_data(username)
+    if user_data is not None:
+        for session_id in user_data["chat_sessions"]:
+            update_search_session(user_index, session_id, read_session_messages(username, session_id))
+        if user_data.get("current_session_id"):
+            update_search_session(user_index, user_data["current_session_id"], user_data["chat_history"])
+    return user_index
+
+
+def get_user_search_index(username):
+    search_index = get_search_index()
+    with search_index["lock"]:
+        entry = search_index["users"].get(username)
+        if entry is None:
+            entry = {"lock": threading.RLock(), "index": None}
+            search_index["users"][username] = entry
+
+    with entry["lock"]:
+        if entry["index"] is None:
+            entry["index"] = build_user_search_index(username)
+    return entry
+
+
+def index_session_messages(username, session_id, messages):
+    try:
+        entry = get_user_search_index(username)
+        with entry["lock"]:
+            update_search_session(entry["index"], session_id, messages)
+    except Exception:
+        pass
+
+
+def replace_search_session(username, session_id, messages):
+    search_index = get_search_index()
+    with search_index["lock"]:
+        entry = search_index["users"].get(username)
+    if entry is None:
+        return
+
+    with entry["lock"]:
+        if entry["index"] is not None:
+            remove_search_session(entry["index"], session_id)
+            update_search_session(entry["index"], session_id, messages)
+
+
+def release_current_session_index():
+    session_id = st.session_state.current_session_id
+    session = st.session_state.chat_sessions.get(session_id)
+    messages = []
+    if session is not None:
+        messages = session.get("messages")
+        if messages is None:
+            messages = read_session_messages(st.session_state.current_user, session_id)
+    replace_search_session(st.session_state.current_user, session_id, messages)
+
+
+def drop_user_search_index(username):
+    search_index = get_search_index()
+    with search_index["lock"]:
+        search_index["users"].pop(username, None)
+
+
+def rank_search_documents(index, query, top_k, exclude_session_id=None):
+    query_terms = set(tokenize_search_text(query))
+    docs = index["docs"]
+    if not query_terms or not docs or top_k <= 0:
+        return []
+
+    average_length = index["total_length"] / len(docs)
+    scores = {}
+    for term in query_terms:
+        postings = index["postings"].get(term)
+        if not postings:
+            continue
+        idf = math.log(1 + (len(docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+        for doc_id, count in postings.items():
+            length = docs[doc_id][2]
+            scores[doc_id] = scores.get(doc_id, 0) + idf * count * (SEARCH_BM25_K1 + 1) / (
+                    count + SEARCH_BM25_K1 * (1 - SEARCH_BM25_B + SEARCH_BM25_B * length / average_length))
+
+    return heapq.nlargest(top_k, ((score, doc_id) for doc_id, score in scores.items()
+                                  if docs[doc_id][0] != exclude_session_id))
+
+
+def search_past_sessions(username, query, exclude_session_id=None, top_k=SEARCH_TOP_K):
+    try:
+        entry = get_user_search_index(username)
+    except Exception:
+        return []
+
+    with entry["lock"]:
+        user_index = entry["index"]
+        docs = user_index["docs"]
+        return [(score, docs[doc_id][0], docs[doc_id][1])
+                for score, doc_id in rank_search_documents(user_index, query, top_k, exclude_session_id)]
+
+
+def split_custom_data(custom_data):
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", custom_data.strip()):
+        if get_token_count(paragraph) <= CUSTOM_DATA_CHUNK_TOKENS:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(line for line in paragraph.splitlines() if line.strip())
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = get_token_count(piece)
+        if current and current_tokens + piece_tokens > CUSTOM_DATA_CHUNK_TOKENS:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+@st.cache_resource
+def get_custom_data_holder():
+    return {"lock": threading.Lock(), "hash": None, "index": None}
+
+
+def get_custom_data_index(custom_data):
+    content_hash = hashlib.sha256(custom_data.encode("utf-8")).hexdigest()
+    holder = get_custom_data_holder()
+    with holder["lock"]:
+        if holder["hash"] != content_hash:
+            index = create_search_index()
+            index["chunks"] = split_custom_data(custom_data) if custom_data.strip() else []
+            index["tokens"] = get_token_count(custom_data)
+            for position, chunk in enumerate(index["chunks"]):
+                add_search_document(index, position, chunk)
+            holder["hash"] = content_hash
+            holder["index"] = index
+        return holder["index"]
+
+
+def select_custom_data_context(custom_data, query):
+    if not custom_data.strip():
+        return ""
+
+    index = get_custom_data_index(custom_data)
+    if index["tokens"] <= CUSTOM_DATA_INLINE_TOKENS:
+        return custom_data
+
+    positions = sorted(index["docs"][doc_id][0] for _, doc_id in
+                       rank_search_documents(index, query, CUSTOM_DATA_TOP_K))
+    return "\n\n".join(index["chunks"][position] for position in positions)
+
+
+@st.cache_resource
+def get_context_executor():
+    return ThreadPoolExecutor(max_workers=CONTEXT_WORKERS, thread_name_prefix="context")
+
+
+def prepare_conversation_context(username, session_id, chat_history, rolling_summary, sessions, max_messages,
+                                 summarize_old_context):
+    context = {
+        "session_id": session_id,
+        "rolling_summary": None,
+        "session_summaries": {}
+    }
+
+    try:
+        get_user_search_index(username)
+    except Exception:
+        pass
+
+    if summarize_old_context and len(chat_history) + 1 > max_messages:
+        old_messages = chat_history[:len(chat_history) + 1 - max_messages]
+        context["rolling_summary"], _ = update_rolling_summary(rolling_summary, old_messages, session_id)
+
+    for previous_session_id, session_data in sessions:
+        if session_data.get("summary_hash") is None:
+            session_messages = session_data.get("messages")
+            if session_messages is None:
+                session_messages = read_session_messages(username, previous_session_id)
+            if session_messages:
+                summarize_session(session_data, session_messages)
+                if session_data.get("summary_hash") is not None:
+                    context["session_summaries"][previous_session_id] = (session_data["summary"],
+                                                                         session_data["summary_hash"])
+
+    return context
+
+
+def schedule_context_precomputation():
+    admin_settings = load_admin_settings()
+    memory_settings = admin_settings.get("memory_settings", {})
+    sessions = [(session_id, dict(session_data))
+                for session_id, session_data in list(st.session_state.chat_sessions.items())[-3:]
+                if session_id != st.session_state.current_session_id]
+    rolling_summary = st.session_state.get("rolling_summary")
+
+    st.session_state.context_future = get_context_executor().submit(
+        prepare_conversation_context,
+        st.session_state.current_user,
+        st.session_state.current_session_id,
+        list(st.session_state.chat_history),
+        dict(rolling_summary) if rolling_summary else None,
+        sessions,
+        memory_settings.get("max_context_messages", 20),
+        memory_settings.get("summarize_old_context", True)
+    )
+
+
+def apply_precomputed_context(discard_pending=False):
+    future = st.session_state.get("context_future")
+    if future is None:
+        return
+    if not future.done():
+        if discard_pending:
+            st.session_state.context_future = None
+        return
+    st.session_state.context_future = None
+
+    try:
+        context = future.result()
+    except Exception:
+        return
+
+    if context["session_id"] != st.session_state.current_session_id:
+        return
+
+    rolling_summary = context["rolling_summary"]
+    current_rolling_summary = st.session_state.get("rolling_summary") or {}
+    if rolling_summary is not None and (current_rolling_summary.get("session_id") != rolling_summary["session_id"] or
+                                        rolling_summary["covered"] >= current_rolling_summary.get("covered", 0)):
+        st.session_state.rolling_summary = rolling_summary
+
+    for session_id, (summary, summary_hash) in context["session_summaries"].items():
+        session_data = st.session_state.chat_sessions.get(session_id)
+        if session_data is not None and session_data.get("summary_hash") is None:
+            session_data["summary"] = summary
+            session_data["summary_hash"] = summary_hash
+
+
+def pack_context_messages(context_messages, messages, system_prompt, max_context_tokens, model):
+    window = MODEL_CONTEXT_WINDOWS.get(model, MODEL_CONTEXT_WINDOWS["gpt-4"])
+    available = window - RESPONSE_MAX_TOKENS - get_token_count(system_prompt, model) - MESSAGE_TOKEN_OVERHEAD
+    budget = max(0, min(max_context_tokens, available))
+
+    candidates = context_messages + messages
+    packed = []
+    used = 0
+    truncated = False
+    dropped = 0
+
+    for index, message in enumerate(reversed(candidates)):
+        cost = get_message_token_count(message) + MESSAGE_TOKEN_OVERHEAD
+        if index == 0 or (used + cost <= budget and (not truncated or message["role"] == "system")):
+            packed.append(message)
+            used += cost
+        else:
+            if message["role"] != "system":
+                truncated = True
+            dropped += 1
+
+    packed.reverse()
+    st.session_state.context_report = {
+        "model": model,
+        "budget": budget,
+        "used": used,
+        "messages": sum(1 for message in packed if message["role"] != "system"),
+        "summaries": sum(1 for message in packed if message["role"] == "system"),
+        "dropped": dropped,
+        "over_budget": used > available
+    }
+    return packed
+
+
+def manage_conversation_memory(messages, system_prompt):
+    apply_precomputed_context(discard_pending=True)
+
     admin_settings = load_admin_settings()
     memory_settings = admin_settings.get("memory_settings", {
         "max_context_messages": 20,
@@ -1522,47 +3093,87 @@ def manage_conversation_memory(messages):
     max_tokens = memory_settings["max_context_tokens"]
 
     all_context_messages = []
-
-    if st.session_state.chat_sessions:
-        for session_id, session_data in list(st.session_state.chat_sessions.items())[-3:]:
-            if session_id != st.session_state.current_session_id:
-                session_messages = session_data.get('messages', [])
-                if session_messages:
-                    session_summary = create_conversation_summary(session_messages)
-                    if session_summary:
-                        all_context_messages.append({
-                            "role": "system",
-                            "content": f"[Session {session_data.get('name', 'Previous')}: {session_summary}]",
-                            "timestamp": format_message_time()
-                        })
+    executor = get_summary_executor()
+    deadline = time.time() + SUMMARY_TIMEOUT
+
+    recent_sessions = [(session_id, session_data)
+                       for session_id, session_data in list(st.session_state.chat_sessions.items())[-3:]
+                       if session_id != st.session_state.current_session_id]
+    summary_jobs = {}
+    for session_id, session_data in recent_sessions:
+        if session_data.get("summary_hash") is None:
+            session_messages = session_data.get("messages")
+            if session_messages is None:
+                session_messages = read_session_messages(st.session_state.current_user, session_id)
+            if session_messages:
+                summary_state = dict(session_data)
+                summary_jobs[session_id] = (executor.submit(summarize_session, summary_state, session_messages),
+                                            summary_state, session_messages)
 
     current_messages = messages.copy()
+    rolling_job = None
 
     if len(current_messages) > max_messages:
+        old_messages = current_messages[:-max_messages]
+        recent_messages = current_messages[-max_messages:]
         if memory_settings["summarize_old_context"]:
-            old_messages = current_messages[:-max_messages]
-            recent_messages = current_messages[-max_messages:]
-
-            summary = create_conversation_summary(old_messages)
-            if summary:
-                summary_message = {"role": "system", "content": summary, "timestamp": format_message_time()}
-                current_messages = [summary_message] + recent_messages
+            rolling_job = executor.submit(update_rolling_summary, st.session_state.get("rolling_summary"),
+                                          old_messages, st.session_state.current_session_id)
         else:
-            current_messages = current_messages[-max_messages:]
+            current_messages = recent_messages
 
-    final_messages = all_context_messages + current_messages
+    retrieved = []
+    if messages and messages[-1]["role"] == "user":
+        retrieved = search_past_sessions(st.session_state.current_user, messages[-1]["content"],
+                                         st.session_state.current_session_id,
+                                         memory_settings.get("retrieval_top_k", SEARCH_TOP_K))
 
-    total_tokens = get_conversation_token_count(final_messages)
-    if total_tokens > max_tokens:
-        if all_context_messages:
-            final_messages = all_context_messages[-1:] + current_messages
+    for session_id, session_data in recent_sessions:
+        if session_id in summary_jobs:
+            future, summary_state, session_messages = summary_jobs[session_id]
+            try:
+                session_summary = future.result(timeout=max(0, deadline - time.time()))
+                if summary_state.get("summary_hash") is not None:
+                    session_data["summary"] = summary_state["summary"]
+                    session_data["summary_hash"] = summary_state["summary_hash"]
+            except Exception:
+                session_summary = summarize_conversation_keywords(session_messages)
         else:
-            final_messages = current_messages
+            session_summary = session_data.get("summary") or ""
 
-    return final_messages
+        if session_summary:
+            all_context_messages.append({
+                "role": "system",
+                "content": f"[Session {session_data.get('name', 'Previous')}: {session_summary}]",
+                "timestamp": format_message_time()
+            })
+
+    if rolling_job is not None:
+        try:
+            rolling_summary, summary = rolling_job.result(timeout=max(0, deadline - time.time()))
+            st.session_state.rolling_summary = rolling_summary
+        except Exception:
+            summary = summarize_conversation_keywords(old_messages)
+        if summary:
+            summary_message = {"role": "system", "content": summary, "timestamp": format_message_time()}
+            current_messages = [summary_message] + recent_messages
+
+    if retrieved:
+        snippets = "\n".join(
+            f"- {st.session_state.chat_sessions.get(session_id, {}).get('name', 'Previous')}: {text}"
+            for _, session_id, text in retrieved)
+        all_context_messages.append({
+            "role": "system",
+            "content": f"[Relevant past conversations:\n{snippets}]",
+            "timestamp": format_message_time()
+        })
+
+    return pack_context_messages(all_context_messages, current_messages, system_prompt, max_tokens,
+                                 st.session_state.model)
 
 
 def save_current_session():
+    previous_session = st.session_state.chat_sessions.get(st.session_state.current_session_id, {})
     session_data = {
         "id": st.session_state.current_session_id,
         "name": f"Chat {datetime.now().strftime('%m/%d %H:%M')}",
@@ -1570,20 +3181,30 @@ def save_current_session():
         "model": st.session_state.model,
         "created_at": datetime.now().isoformat(),
         "message_count": st.session_state.message_count,
-        "total_tokens": st.session_state.total_tokens
+        "total_tokens": st.session_state.total_tokens,
+        "summary": previous_session.get("summary"),
+        "summary_hash": previous_session.get("summary_hash"),
+        "rolling_summary": st.session_state.get("rolling_summary")
     }
+    summarize_session(session_data, session_data["messages"])
     st.session_state.chat_sessions[st.session_state.current_session_id] = session_data
+    index_session_messages(st.session_state.current_user, session_data["id"], session_data["messages"])
     save_data_to_file()
 
 
 def load_session(session_id):
     if session_id in st.session_state.chat_sessions:
         session = st.session_state.chat_sessions[session_id]
-        st.session_state.chat_history = session["messages"]
+        messages = session.get("messages")
+        if messages is None:
+            messages = read_session_messages(st.session_state.current_user, session_id)
+        release_current_session_index()
+        st.session_state.chat_history = list(messages)
         st.session_state.current_session_id = session_id
         st.session_state.model = session.get("model", "gpt-4o-mini")
         st.session_state.message_count = session.get("message_count", 0)
         st.session_state.total_tokens = session.get("total_tokens", 0)
+        st.session_state.rolling_summary = session.get("rolling_summary")
         save_data_to_file()
         st.success(f"Loaded session: {session['name']}")
         time.sleep(1)
@@ -1628,10 +3249,44 @@ def clear_chat():
     st.rerun()
 
 
-def display_message(message):
-    admin_settings = load_admin_settings()
-    app_config = admin_settings.get("app_config", {})
-    assistant_avatar = app_config.get("assistant_avatar", "🐱")
+def iter_stream_text(response):
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content is not None:
+            yield chunk.choices[0].delta.content
+
+
+def iter_cached_text(text):
+    for start in range(0, len(text), RESPONSE_CACHE_REPLAY_CHARS):
+        yield text[start:start + RESPONSE_CACHE_REPLAY_CHARS]
+
+
+def render_stream(placeholder, pieces, flush_interval=None):
+    if flush_interval is None:
+        flush_interval = load_admin_settings().get("stream_flush_interval", STREAM_FLUSH_INTERVAL)
+
+    parts = []
+    pending = 0
+    last_flush = time.monotonic()
+    for piece in pieces:
+        parts.append(piece)
+        pending += len(piece)
+        now = time.monotonic()
+        if pending >= STREAM_FLUSH_CHARS or now - last_flush >= flush_interval:
+            parts = ["".join(parts)]
+            placeholder.markdown(parts[0] + "▌")
+            pending = 0
+            last_flush = now
+
+    full_response = "".join(parts)
+    placeholder.markdown(full_response)
+    return full_response
+
+
+def display_message(message, assistant_avatar=None):
+    if assistant_avatar is None:
+        admin_settings = load_admin_settings()
+        app_config = admin_settings.get("app_config", {})
+        assistant_avatar = app_config.get("assistant_avatar", "🐱")
 
     role = message["role"]
     content = message["content"]
@@ -1681,8 +3336,7 @@ with st.sidebar:
     with col1:
         st.title(app_title)
         if "current_user" in st.session_state and st.session_state.current_user:
-            users = load_users()
-            user_name = users.get(st.session_state.current_user, {}).get("name", st.session_state.current_user)
+            user_name = (get_user(st.session_state.current_user) or {}).get("name", st.session_state.current_user)
             st.caption(f"Welcome, {user_name}")
     with col2:
         if st.button("Logout", use_container_width=True):
@@ -1717,12 +3371,21 @@ with st.sidebar:
     st.markdown("---")
     st.subheader("Chat Statistics")
 
+    apply_precomputed_context()
     current_tokens = get_conversation_token_count(st.session_state.chat_history)
     st.metric("Current Session Messages", len(st.session_state.chat_history))
     st.metric("Current Session Tokens", current_tokens)
     st.metric("Total Messages Sent", st.session_state.message_count)
     st.metric("Total Tokens Used", st.session_state.total_tokens)
 
+    context_report = st.session_state.get("context_report")
+    if context_report:
+        st.caption(f"Last request context: {context_report['used']}/{context_report['budget']} tokens, "
+                   f"{context_report['messages']} messages, {context_report['summaries']} summaries, "
+                   f"{context_report['dropped']} dropped")
+        if context_report["over_budget"]:
+            st.warning(f"Latest message exceeds the {context_report['model']} context window")
+
     admin_settings = load_admin_settings()
     memory_settings = admin_settings.get("memory_settings", {
         "max_context_messages": 20,
@@ -1746,6 +3409,7 @@ with st.sidebar:
 admin_settings = load_admin_settings()
 app_config = admin_settings.get("app_config", {})
 app_title = app_config.get("app_title", "CatGPT")
+assistant_avatar = app_config.get("assistant_avatar", "🐱")
 
 st.markdown(f"""
     <div style="text-align: center; margin-bottom: 2rem;">
@@ -1754,18 +3418,19 @@ st.markdown(f"""
 """, unsafe_allow_html=True)
 
 for message in st.session_state.chat_history:
-    display_message(message)
+    display_message(message, assistant_avatar)
 
 if prompt := st.chat_input("What would you like to know?"):
     user_message = {
         "role": "user",
         "content": prompt,
-        "timestamp": format_message_time()
+        "timestamp": format_message_time(),
+        "tokens": get_token_count(prompt, st.session_state.model)
     }
     st.session_state.chat_history.append(user_message)
     st.session_state.message_count += 1
 
-    display_message(user_message)
+    display_message(user_message, assistant_avatar)
 
     if detect_image_request(prompt):
         can_generate, limit_message = check_image_generation_limit(st.session_state.current_user)
@@ -1792,7 +3457,7 @@ if prompt := st.chat_input("What would you like to know?"):
             with st.chat_message("assistant", avatar=assistant_avatar):
                 with st.spinner("LexGPT is generating your image..."):
                     try:
-                        image_url = generate_dalle_image(prompt)
+                        image_url = generate_dalle_image(prompt, get_queue_notifier(st.empty()))
                         increment_image_usage(st.session_state.current_user)
 
                         col1, col2, col3 = st.columns([1, 2, 1])
@@ -1829,8 +3494,6 @@ if prompt := st.chat_input("What would you like to know?"):
                         st.session_state.chat_history.append(error_message)
                         save_data_to_file()
     else:
-        managed_history = manage_conversation_memory(st.session_state.chat_history)
-
         admin_settings = load_admin_settings()
         app_config = admin_settings.get("app_config", {})
         assistant_avatar = app_config.get("assistant_avatar", "🐱")
@@ -1840,11 +3503,14 @@ if prompt := st.chat_input("What would you like to know?"):
         base_system_prompt = admin_settings.get("system_prompt",
                                                 f"You are {model_name}, a helpful AI assistant. You have access to our previous conversation history and can reference past messages to provide contextual responses.")
 
-        if custom_data.strip():
-            system_prompt = f"{base_system_prompt}\n\nAdditional Context - Team & Organization Information:\n{custom_data}"
+        custom_context = select_custom_data_context(custom_data, prompt)
+        if custom_context:
+            system_prompt = f"{base_system_prompt}\n\nAdditional Context - Team & Organization Information:\n{custom_context}"
         else:
             system_prompt = base_system_prompt
 
+        managed_history = manage_conversation_memory(st.session_state.chat_history, system_prompt)
+
         api_messages = [{"role": "system", "content": system_prompt}]
 
         for msg in managed_history:
@@ -1854,36 +3520,57 @@ if prompt := st.chat_input("What would you like to know?"):
         with st.chat_message("assistant", avatar=assistant_avatar):
             with st.spinner(f"{model_name} is thinking..."):
                 try:
-                    response = openai.chat.completions.create(
-                        model=st.session_state.model,
-                        messages=api_messages,
-                        temperature=0.7,
-                        max_tokens=2000,
-                        stream=True
-                    )
+                    cache_settings = dict(RESPONSE_CACHE_DEFAULTS, **admin_settings.get("response_cache", {}))
+                    request_key = get_response_cache_key(st.session_state.model, api_messages,
+                                                         RESPONSE_TEMPERATURE, RESPONSE_MAX_TOKENS)
+                    cache_key = None
+                    similar_context_key = None
+                    cached_response = None
+                    if cache_settings["enabled"]:
+                        cache_key = request_key
+                        cached_response = lookup_response_cache(cache_key, cache_settings["ttl"])
+                        if cache_settings["near_duplicates"] and len(api_messages) == 2:
+                            similar_context_key = get_response_cache_key(st.session_state.model, api_messages[:1],
+                                                                         RESPONSE_TEMPERATURE, RESPONSE_MAX_TOKENS)
+                            if cached_response is None:
+                                cached_response = lookup_similar_response(
+                                    similar_context_key, prompt,
+                                    max(NEAR_DUPLICATE_MIN_THRESHOLD, float(cache_settings["similarity_threshold"])),
+                                    cache_settings["ttl"])
 
                     response_placeholder = st.empty()
-                    full_response = ""
-
-                    for chunk in response:
-                        if chunk.choices[0].delta.content is not None:
-                            full_response += chunk.choices[0].delta.content
-                            response_placeholder.markdown(full_response + "▌")
-
-                    response_placeholder.markdown(full_response)
+                    if cached_response is not None:
+                        full_response = render_stream(response_placeholder, iter_cached_text(cached_response))
+                    else:
+                        client = get_client()
+                        model = st.session_state.model
+                        full_response = render_stream(response_placeholder, stream_single_flight(
+                            request_key, lambda: client.chat.completions.create(
+                                model=model,
+                                messages=api_messages,
+                                temperature=RESPONSE_TEMPERATURE,
+                                max_tokens=RESPONSE_MAX_TOKENS,
+                                stream=True
+                            ), st.session_state.current_user, get_queue_notifier(st.empty())))
+                        if cache_key is not None and full_response:
+                            store_response_cache(cache_key, full_response, int(cache_settings["max_entries"]))
+                        if similar_context_key is not None and full_response:
+                            store_similar_response(similar_context_key, prompt, full_response,
+                                                   int(cache_settings["max_entries"]))
 
                     assistant_message = {
                         "role": "assistant",
                         "content": full_response,
-                        "timestamp": format_message_time()
+                        "timestamp": format_message_time(),
+                        "tokens": get_token_count(full_response, st.session_state.model)
                     }
                     st.session_state.chat_history.append(assistant_message)
 
-                    response_tokens = get_token_count(full_response, st.session_state.model)
-                    prompt_tokens = get_token_count(prompt, st.session_state.model)
-                    st.session_state.total_tokens += response_tokens + prompt_tokens
+                    if cached_response is None:
+                        st.session_state.total_tokens += assistant_message["tokens"] + user_message["tokens"]
 
                     save_data_to_file()
+                    schedule_context_precomputation()
 
                 except Exception as e:
                     st.error(f"Error: {str(e)}")